@@ -0,0 +1,101 @@
+"""Batch spreadsheet cleaner.
+
+Cleans every spreadsheet matching the given paths (files, directories or glob patterns) against
+one rules file, without the GUI, so it can run on a server or from a scheduled task. For each
+input, the cleaned data is saved as <name>.csv (or .parquet) and the review workbook as <name>_review.xlsx in
+the output directory, then a table of corrections and flags per file is printed.
+
+Example:
+
+    py batch_clean.py -r templates/example.rules.xlsx -o cleaned "daily/*.csv" -w 4
+
+"""
+
+import argparse  # for command line arg parsing
+import multiprocessing
+import sys
+
+from tabulate import tabulate  # for the summary table
+
+from local_modules.autocorrect import autocorrect
+from local_modules.spreadcheck import batch, review
+
+
+def parse_args(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Autocorrect and validate spreadsheets against a rules file')
+    arg_parser.add_argument('inputs',
+                            nargs='+',
+                            help='spreadsheets to clean: files, directories or glob patterns')
+    arg_parser.add_argument('-r',
+                            '--rules',
+                            required=True,
+                            help='the rules file (an Excel workbook with a sheet per column)')
+    arg_parser.add_argument('-o',
+                            '--output',
+                            required=True,
+                            help='directory to write cleaned files and review workbooks to')
+    arg_parser.add_argument('-w',
+                            '--workers',
+                            type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='files to clean at a time (default: one per CPU)')
+    arg_parser.add_argument('-t',
+                            '--temp-dir',
+                            help='where to put temporary files (default: the system temp directory)')
+    arg_parser.add_argument('-f',
+                            '--format',
+                            choices=['csv', 'parquet'],
+                            default='csv',
+                            help='format to save the cleaned data in (default: csv)')
+    arg_parser.add_argument('--chunksize',
+                            type=int,
+                            help='stream csv, tsv, xlsx and parquet inputs this many rows at a time')
+    arg_parser.add_argument('--flagged-only',
+                            action='store_true',
+                            help='review workbooks hold just the flagged rows')
+    arg_parser.add_argument('--flags-sheet',
+                            action='store_true',
+                            help='add a sheet listing every flag to review workbooks')
+    arg_parser.add_argument('--comment-limit',
+                            type=int,
+                            default=review.COMMENT_LIMIT,
+                            help='most flagged cells to annotate with a comment, per file, the rest are listed on '
+                                 'the Flags sheet (default: {})'.format(review.COMMENT_LIMIT))
+    arg_parser.add_argument('--profile',
+                            action='store_true',
+                            help='save a cProfile of each file\'s run as <name>.prof in the output directory')
+    return arg_parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    inputs = batch.find_inputs(args.inputs)
+    if not inputs:
+        print("No spreadsheets found at " + ", ".join(args.inputs), file=sys.stderr)
+        return 1
+
+    # rules are read once (or not at all, if unchanged since they were cached), then handed to every worker
+    rules = autocorrect.fields(args.rules, autocorrect.user_cache_dir())
+    options = {
+        'tempfolder': args.temp_dir,
+        'extension': '.' + args.format,
+        'chunksize': args.chunksize,
+        'flagged_only': args.flagged_only,
+        'flags_sheet': args.flags_sheet,
+        'comment_limit': args.comment_limit,
+        'profile': args.profile,
+    }
+    try:
+        results = batch.clean_batch(inputs, rules, args.output, args.workers, options)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+
+    print(tabulate(batch.summary_rows(results), headers=batch.SUMMARY_COLUMNS))
+    return 1 if any(result.errors for _, result in results) else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""Benchmarks for the spreadsheet cleaner and the duplicate finder.
+
+Times the gui's startup imports, autocorrect.fields, spreadcheck.clean (with and without the review workbook) and
+nedss_duplicate_finder.get_dupe_index_groups on the files in sample_data and on synthetic inputs of the given sizes,
+recording throughput and peak memory in a JSON results file. Results are compared against a stored baseline, so a slowdown shows up as a regression instead of a hunch.
+
+Example:
+
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 -o results.json
+
+Each benchmark runs in a fresh process, so its peak memory is its own.
+"""
+
+import argparse  # for command line arg parsing
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate  # for the results table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'deduplication'))
+
+from local_modules.autocorrect import autocorrect
+from local_modules.datagen import datagen
+from local_modules.spreadcheck.timing import peak_memory_mb
+
+SAMPLE_DATA = os.path.join(ROOT, 'sample_data')
+SAMPLE_RULES = os.path.join(SAMPLE_DATA, 'sample.rules.xlsx')
+SAMPLE_INPUTS = ['sample.data.small.xlsx', 'sample.data.large.xlsx']
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+# the gui, and the data modules it loads in the background once its window is up
+STARTUP_MODULES = ['main.py', os.path.join('local_modules', 'spreadcheck', 'spreadcheck.py'),
+                   os.path.join('local_modules', 'autocorrect', 'autocorrect.py')]
+
+
+################################
+#   INPUTS                     #
+################################
+
+def prepare_inputs(work_dir, sizes, dedup_sizes):
+    """Writes the synthetic inputs to work_dir (once per size), returning input name -> (path, rows)"""
+    rules = autocorrect.fields(SAMPLE_RULES)
+    inputs = {}
+    for name in SAMPLE_INPUTS:
+        path = os.path.join(SAMPLE_DATA, name)
+        inputs[name] = (path, len(pd.read_excel(path)))
+    for rows in sorted(set(sizes) | set(dedup_sizes)):
+        path = os.path.join(work_dir, 'synthetic.{}.csv'.format(rows))
+        if not os.path.exists(path):
+            datagen.write(path, rules, rows)
+        inputs['synthetic-{}'.format(rows)] = (path, rows)
+    return inputs
+
+
+################################
+#   BENCHMARKS                 #
+################################
+
+# Each benchmark function takes its input's path and the benchmark options, does any setup, and returns a
+# function to time, which returns the number of rows it handled.
+
+def fields(path, options):
+    return lambda: sum(len(rule['allowed_value_set']) for rule in autocorrect.fields(path).values())
+
+
+def fields_cached(path, options):
+    cache_dir = tempfile.mkdtemp(dir=options['work_dir'])
+    autocorrect.fields(path, cache_dir)
+    return lambda: sum(len(rule['allowed_value_set']) for rule in autocorrect.fields(path, cache_dir).values())
+
+
+def clean(path, options, review=False):
+    """Loads, checks and stores the cleaned data, and with review also writes the review workbook, as the gui
+    does once someone asks to see it. Settings are the shipped defaults (e.g. review.COMMENT_LIMIT comments).
+    """
+    from local_modules.spreadcheck import spreadcheck
+
+    rules = autocorrect.fields(SAMPLE_RULES)
+    tempfolder = tempfile.mkdtemp(dir=options['work_dir'])
+
+    def run():
+        results = spreadcheck.clean(path, rules, tempfolder, workers=options['workers'], review=review)
+        if results.errors:
+            raise RuntimeError('; '.join(results.errors))
+        return results.rows
+    return run
+
+
+def clean_review(path, options):
+    return clean(path, options, review=True)
+
+
+def dedup(path, options, exhaustive=False):
+    import nedss_duplicate_finder as nedss
+
+    df = nedss.preprocess(pd.read_csv(path) if path.endswith('.csv') else pd.read_excel(path))
+    # the last dedup_new records are new, scored against the earlier ones they share a block key with
+    split_index = max(len(df) - options['dedup_new'], 1)
+    block_keys = None if exhaustive else nedss.DEFAULT_BLOCK_KEYS
+    return lambda: len(df) if nedss.get_dupe_index_groups(df, split_index, block_keys, options['workers']) is not None else 0
+
+
+def dedup_exhaustive(path, options):
+    return dedup(path, options, exhaustive=True)
+
+
+def startup(path, options):
+    """Imports the module at path (relative to the repo) in a new interpreter, for main.py the wait before the
+    window can open
+    """
+    module = os.path.splitext(path)[0].replace(os.sep, '.')
+    command = [sys.executable, '-c', 'import ' + module]
+
+    def run():
+        subprocess.run(command, cwd=ROOT, check=True)
+        return 1
+    return run
+
+
+BENCHMARKS = {
+    'startup': startup,
+    'fields': fields,
+    'fields-cached': fields_cached,
+    'clean': clean,
+    'clean-review': clean_review,
+    'dedup': dedup,
+    'dedup-exhaustive': dedup_exhaustive,
+}
+
+
+def run_case(benchmark, input_name, path, options):
+    """Runs one benchmark options['repeat'] times, returning its best time and the process's peak memory"""
+    run = BENCHMARKS[benchmark](path, options)
+    times = []
+    for _ in range(options['repeat']):
+        start = time.perf_counter()
+        rows = run()
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    return {
+        'benchmark': benchmark,
+        'input': input_name,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds) if seconds else None,
+        'peak_memory_mb': peak_memory_mb()
+    }
+
+
+def cases(inputs, sizes, dedup_sizes):
+    for path in STARTUP_MODULES:
+        yield 'startup', path, path
+    yield 'fields', 'sample.rules.xlsx', SAMPLE_RULES
+    yield 'fields-cached', 'sample.rules.xlsx', SAMPLE_RULES
+    for benchmark in ('clean', 'clean-review'):
+        for name in SAMPLE_INPUTS:
+            yield benchmark, name, inputs[name][0]
+        for rows in sizes:
+            yield benchmark, 'synthetic-{}'.format(rows), inputs['synthetic-{}'.format(rows)][0]
+    for name in SAMPLE_INPUTS:
+        yield 'dedup', name, inputs[name][0]
+    for rows in dedup_sizes:
+        yield 'dedup', 'synthetic-{}'.format(rows), inputs['synthetic-{}'.format(rows)][0]
+        yield 'dedup-exhaustive', 'synthetic-{}'.format(rows), inputs['synthetic-{}'.format(rows)][0]
+
+
+################################
+#   RESULTS                    #
+################################
+
+def compare(results, baseline, tolerance, min_seconds=0.1):
+    """Adds each result's time relative to the baseline's, returning the results that got slower than tolerance
+    allows. Slowdowns of less than min_seconds are left out, as timer noise.
+    """
+    previous = {(result['benchmark'], result['input']): result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result['benchmark'], result['input']))
+        if before is None or not before['seconds']:
+            continue
+        result['vs_baseline'] = round(result['seconds'] / before['seconds'], 3)
+        if result['vs_baseline'] > 1 + tolerance and result['seconds'] - before['seconds'] > min_seconds:
+            regressions.append(result)
+    return regressions
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__
+    }
+
+
+def parse_args(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Benchmark the spreadsheet cleaner and duplicate finder')
+    arg_parser.add_argument('--sizes',
+                            type=int,
+                            nargs='*',
+                            default=[10000, 100000],
+                            help='rows of synthetic data to clean (default: 10000 100000)')
+    arg_parser.add_argument('--dedup-sizes',
+                            type=int,
+                            nargs='*',
+                            default=[1000, 10000],
+                            help='rows of synthetic person records to dedup (default: 1000 10000)')
+    arg_parser.add_argument('--dedup-new',
+                            type=int,
+                            default=100,
+                            help='how many of the last records count as new when deduping (default: 100)')
+    arg_parser.add_argument('--only',
+                            nargs='*',
+                            choices=sorted(BENCHMARKS),
+                            help='run just these benchmarks')
+    arg_parser.add_argument('--repeat',
+                            type=int,
+                            default=3,
+                            help='runs of each benchmark, the fastest counts (default: 3)')
+    arg_parser.add_argument('--workers',
+                            type=int,
+                            help='workers for clean and dedup')
+    arg_parser.add_argument('--work-dir',
+                            help='where to keep generated inputs and outputs (default: a new temp directory)')
+    arg_parser.add_argument('-o',
+                            '--output',
+                            default='benchmark_results.json',
+                            help='results file to write (default: benchmark_results.json)')
+    arg_parser.add_argument('--baseline',
+                            default=BASELINE,
+                            help='results file to compare against (default: benchmarks/baseline.json)')
+    arg_parser.add_argument('--tolerance',
+                            type=float,
+                            default=0.25,
+                            help='how much slower than the baseline counts as a regression (default: 0.25)')
+    arg_parser.add_argument('--save-baseline',
+                            action='store_true',
+                            help='also write the results to the baseline file')
+    return arg_parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmarks-')
+    os.makedirs(work_dir, exist_ok=True)
+    options = {'work_dir': work_dir, 'repeat': args.repeat, 'workers': args.workers, 'dedup_new': args.dedup_new}
+
+    inputs = prepare_inputs(work_dir, args.sizes, args.dedup_sizes)
+    results = []
+    for benchmark, input_name, path in cases(inputs, args.sizes, args.dedup_sizes):
+        if args.only and benchmark not in args.only:
+            continue
+        # a fresh process each, so peak memory isn't left over from an earlier benchmark
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(run_case, benchmark, input_name, path, options).result()
+        results.append(result)
+        print("{} on {}: {:.3f}s".format(benchmark, input_name, result['seconds']), file=sys.stderr)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    report = {'environment': environment(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        # without the comparison to the baseline it replaces
+        baseline = [{key: value for key, value in result.items() if key != 'vs_baseline'} for result in results]
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': report['environment'], 'results': baseline}, f, indent=2)
+
+    columns = ['benchmark', 'input', 'rows', 'seconds', 'rows_per_sec', 'peak_memory_mb', 'vs_baseline']
+    print(tabulate([[result.get(column) for column in columns] for result in results], headers=columns))
+    for result in regressions:
+        print("REGRESSION: {} on {} took {}x the baseline".format(result['benchmark'], result['input'],
+                                                                 result['vs_baseline']))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
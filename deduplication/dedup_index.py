@@ -0,0 +1,203 @@
+"""Persistent index of NEDSS person-records for incremental duplicate detection.
+
+Instead of re-reading the whole case history and recomputing its phonetics every week, the history is kept in a
+SQLite file: the preprocessed records (numbered in the order they were added), their block keys, the dupe groups
+found so far (as union-find links) and the matches behind those. A new batch is scored against just the indexed
+records that share a block key with it, then added, its matches extending the stored groups.
+
+    with DedupIndex("nedss.dedup.sqlite") as index:
+        positions = index.add(pd.read_excel("10-06-20_New Cases.xlsx"))
+        dupe_lists, group_ids = index.groups(positions)
+
+"""
+
+import sqlite3  # for the index file
+
+import numpy as np  # for the new records' positions
+import pandas as pd  # for data management/aggs.
+
+import nedss_duplicate_finder as nedss
+
+# bumped when the layout changes, older index files then have to be rebuilt
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS records (
+    position INTEGER PRIMARY KEY,
+    Identifier,
+    Age,
+    Gender,
+    gender_is_nan INTEGER,
+    phonetic_first_name TEXT,
+    phonetic_last_name TEXT,
+    phonetic_address TEXT
+);
+CREATE INDEX IF NOT EXISTS records_identifier ON records (Identifier);
+CREATE TABLE IF NOT EXISTS blocks (name TEXT, key TEXT, position INTEGER);
+CREATE INDEX IF NOT EXISTS blocks_key ON blocks (name, key);
+CREATE TABLE IF NOT EXISTS links (position INTEGER PRIMARY KEY, parent INTEGER);
+CREATE TABLE IF NOT EXISTS matches (record INTEGER, match INTEGER, score INTEGER);
+"""
+
+# the record columns that scoring and block keys use
+RECORD_COLUMNS = ["Identifier", "Age", "Gender", "phonetic_first_name", "phonetic_last_name", "phonetic_address"]
+
+
+class IndexVersionError(Exception):
+    pass
+
+
+class DedupIndex:
+    """A dedup index file, created if it doesn't exist yet"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            version = self.meta("version")
+            if version is None:
+                self.set_meta("version", INDEX_VERSION)
+        if version is not None and int(version) != INDEX_VERSION:
+            self.close()
+            raise IndexVersionError("{} was made by another version, delete it to rebuild it".format(path))
+        # the stored groups, which new matches extend
+        self.linked = nedss.DisjointSet(keep_edges=True)
+        self.linked.parent = dict(self.connection.execute("SELECT position, parent FROM links"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def meta(self, name: str):
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name: str, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, str(value)))
+
+    def block_keys(self) -> list:
+        """The block keys stored for every record"""
+        names = self.meta("block_keys")
+        return names.split() if names else []
+
+    def add(self, nedss_df: pd.DataFrame, block_keys=nedss.DEFAULT_BLOCK_KEYS, workers: int = None,
+            split_index: int = None) -> pd.Series:
+        """Scores the records of nedss_df that aren't in the index yet (by Identifier) against the index and each
+        other, then adds them, linking their matches into the stored groups.
+
+        Records before split_index are added without being scored, as history (e.g. when starting an index from
+        a cumulative file). Returns the index position of every record of nedss_df.
+        """
+        nedss_df.columns = nedss_df.columns.str.strip()
+        known = self.positions_of(nedss_df["Identifier"])
+        new_df = nedss.preprocess(nedss_df[known.isna().to_numpy()].copy())
+
+        start = self.connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM records").fetchone()[0]
+        rows = new_df.index
+        new_df.index = pd.RangeIndex(start, start + len(new_df))
+        first_new = start + int(np.sum(rows < split_index)) if split_index is not None else start
+
+        self.ensure_block_keys(block_keys or [])
+        history = self.candidates(new_df, block_keys)
+        edges = []
+        if len(new_df):
+            combined = pd.concat([history, new_df[RECORD_COLUMNS]])
+            edges = list(nedss.get_match_edges(combined, first_new, block_keys, workers))
+
+        stored = dict(self.linked.parent)
+        for rec_idx, match_idx, score in edges:
+            self.linked.union(rec_idx, match_idx, int(score))
+        with self.connection:
+            self.write_records(new_df)
+            self.connection.executemany("INSERT OR REPLACE INTO links VALUES (?, ?)",
+                                        [(i, parent) for i, parent in self.linked.parent.items()
+                                         if stored.get(i) != parent])
+            self.connection.executemany("INSERT INTO matches VALUES (?, ?, ?)", self.linked.edges)
+        self.linked.edges = []
+
+        positions = known.copy()
+        positions[known.isna().to_numpy()] = new_df.index.to_numpy()
+        return positions.astype("int64")
+
+    def positions_of(self, identifiers: pd.Series) -> pd.Series:
+        """The index position of each of identifiers, NaN for the ones not in the index"""
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (Identifier)")
+            self.connection.execute("DELETE FROM wanted")
+            self.connection.executemany("INSERT INTO wanted VALUES (?)", [(i,) for i in identifiers.tolist()])
+            found = dict(self.connection.execute(
+                    "SELECT Identifier, MIN(position) FROM records WHERE Identifier IN (SELECT Identifier FROM wanted)"
+                    " GROUP BY Identifier"))
+        return pd.Series([found.get(i, np.nan) for i in identifiers.tolist()], index=identifiers.index, dtype=float)
+
+    def candidates(self, new_df: pd.DataFrame, block_keys) -> pd.DataFrame:
+        """The indexed records sharing a block key with any of new_df, all of them if block_keys is None.
+
+        These are all the earlier records any new record gets compared with, so scoring the new records against
+        just them finds the same matches as scoring them against the whole history.
+        """
+        query = "SELECT * FROM records"
+        if block_keys is not None:
+            keys = [(name, key) for name in block_keys for key in set(nedss.BLOCK_KEYS[name](new_df))]
+            with self.connection:
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS batch_keys (name TEXT, key TEXT)")
+                self.connection.execute("DELETE FROM batch_keys")
+                self.connection.executemany("INSERT INTO batch_keys VALUES (?, ?)", keys)
+            query += " WHERE position IN (SELECT position FROM blocks JOIN batch_keys USING (name, key))"
+        return self.read_records(query + " ORDER BY position")
+
+    def read_records(self, query: str) -> pd.DataFrame:
+        records = pd.read_sql_query(query, self.connection, index_col="position")
+        records.index = records.index.astype("int64")
+        # SQLite keeps NaN as NULL, which would make a missing gender blank
+        gender = records["Gender"].astype(object)
+        gender[records.pop("gender_is_nan").astype(bool).to_numpy()] = np.nan
+        records["Gender"] = gender
+        return records[RECORD_COLUMNS]
+
+    def write_records(self, new_df: pd.DataFrame):
+        records = new_df[RECORD_COLUMNS].copy()
+        records["gender_is_nan"] = [isinstance(g, float) and np.isnan(g) for g in records["Gender"]]
+        records.index.name = "position"
+        records.to_sql("records", self.connection, if_exists="append")
+        self.write_block_keys(new_df, self.block_keys())
+
+    def write_block_keys(self, records: pd.DataFrame, names):
+        for name in names:
+            pd.DataFrame({"name": name, "key": nedss.BLOCK_KEYS[name](records).to_numpy(),
+                          "position": records.index}).to_sql("blocks", self.connection, if_exists="append",
+                                                             index=False)
+
+    def ensure_block_keys(self, names):
+        """Stores the block keys the index doesn't have yet for every record, so they can be looked up"""
+        missing = [name for name in names if name not in self.block_keys()]
+        if not missing:
+            return
+        with self.connection:
+            self.write_block_keys(self.read_records("SELECT * FROM records ORDER BY position"), missing)
+            self.set_meta("block_keys", " ".join(self.block_keys() + missing))
+
+    def groups(self, positions: pd.Series):
+        """The dupe groups of the records at positions (as from add), as lists of their labels in positions, with
+        the Identifier of each group's first indexed record as its id
+        """
+        groups = {}
+        for label, position in positions.items():
+            if position in self.linked.parent:
+                groups.setdefault(self.linked.find(position), []).append(label)
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS roots (position INTEGER PRIMARY KEY)")
+            self.connection.execute("DELETE FROM roots")
+            self.connection.executemany("INSERT INTO roots VALUES (?)", [(root,) for root in groups])
+            identifiers = dict(self.connection.execute("SELECT position, Identifier FROM records JOIN roots USING (position)"))
+        return list(groups.values()), [identifiers[root] for root in groups]
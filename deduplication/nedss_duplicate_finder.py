@@ -3,7 +3,9 @@
 This program automates the process of identifying potential duplicate person-records
 in NEDSS data. The program takes two command line arguments (1) the filepath
 for NEDSS data; (2) the Identifier of the first person-record considered new.
-This application will then compare each of the new records to all the preceeding records.
+This application will then compare each of the new records to the preceeding records it shares
+a block key with (e.g. first name initial and last name prefix, phonetically), or with --exhaustive
+to all the preceeding records.
 
 Example: for a new batch of NEDSS data, we need to determine the Identifier value for
 the first record in that dataset that should be considered new. E.g., we may open the
@@ -16,18 +18,23 @@ In this file the column dupe_uuid stores potential duplicate identifiers. Filter
 this data to only the records that contains non-empty values (and sorting on dupe_uuid)
 will present an ordered list of potential dupes for manual review.
 
+With --index, the history is kept in a dedup index file between runs (see dedup_index.py), and
+each run only needs the file with the new records.
+
 """
 
 import argparse  # for command line arg parsing
 
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor  # for scoring on several cores
+import multiprocessing
+import sys
 import jellyfish  # for phonetic representation
+import numpy as np  # for candidate indices and batched scoring
 import openpyxl as xl  # for writing to xls file
 import pandas as pd  # for data management/aggs.
-from scipy import sparse  # for connected comps.
 import textdistance  # for fuzzy string matching
 from tqdm import tqdm  # for process status bar
-from typing import List
+from typing import Dict, List, Tuple
 
 
 def first_name_similarity_scorer(a: str, b: str):
@@ -122,6 +129,69 @@ def preprocess(nedss_df: pd.DataFrame):
     return nedss_df
 
 
+def phonetic_prefix(nedss_df: pd.DataFrame, column: str, length: int) -> pd.Series:
+    return nedss_df["phonetic_" + column].str[:length]
+
+
+def age_band(nedss_df: pd.DataFrame, width: int = 5) -> pd.Series:
+    """Ages in bands of width years, ages that aren't numbers in a band of their own"""
+    return (pd.to_numeric(nedss_df["Age"], errors="coerce") // width).astype(str)
+
+
+# Block keys: records are only compared with earlier records that share a value of at least one of the block keys
+# used. A match needs two of first name, last name and address to match (age and gender only take points away),
+# so the default keys pair those up, and a match gets compared as long as the two fields it matches on start the
+# same way. Each function takes the preprocessed dataframe and returns a key per record.
+BLOCK_KEYS = {
+    "first_last": lambda df: phonetic_prefix(df, "first_name", 1) + "|" + phonetic_prefix(df, "last_name", 2),
+    "first_address": lambda df: phonetic_prefix(df, "first_name", 1) + "|" + phonetic_prefix(df, "address", 2),
+    "last_address": lambda df: phonetic_prefix(df, "last_name", 2) + "|" + phonetic_prefix(df, "address", 2),
+    "last_name": lambda df: phonetic_prefix(df, "last_name", 2),
+    "first_age": lambda df: phonetic_prefix(df, "first_name", 1) + "|" + age_band(df),
+}
+DEFAULT_BLOCK_KEYS = ["first_last", "first_address", "last_address"]
+
+# new records per task when scoring in parallel
+SHARD_SIZE = 64
+
+
+def block_groups(data_df: pd.DataFrame, block_keys: List[str]):
+    """For each block key, every record's key and the positions of the records with each key, in order"""
+    blocks = []
+    for name in block_keys:
+        keys = BLOCK_KEYS[name](data_df).to_numpy()
+        blocks.append((keys, pd.Series(np.arange(len(keys))).groupby(keys).indices))
+    return blocks
+
+
+def earlier_candidates(blocks, position: int):
+    """Positions of the records before position that share a block key with it, every one (as a slice) if blocks
+    is None
+    """
+    if blocks is None:
+        return slice(0, position)
+    earlier = [np.zeros(0, dtype=int)]
+    for keys, groups in blocks:
+        members = groups[keys[position]]
+        earlier.append(members[:np.searchsorted(members, position)])
+    return np.unique(np.concatenate(earlier))
+
+
+def new_positions(data_df: pd.DataFrame, split_index: int) -> range:
+    return range(np.searchsorted(data_df.index.to_numpy(), split_index), len(data_df))
+
+
+def candidate_positions(data_df: pd.DataFrame, split_index: int, block_keys: List[str] = DEFAULT_BLOCK_KEYS):
+    """Yields the position of each new record with the positions of the earlier records to compare it with.
+
+    Those are the earlier records sharing a value of any of the block keys, or every earlier record (as a slice)
+    if block_keys is None.
+    """
+    blocks = None if block_keys is None else block_groups(data_df, block_keys)
+    for position in new_positions(data_df, split_index):
+        yield position, earlier_candidates(blocks, position)
+
+
 def score_record_against_records(nedss_df: pd.DataFrame, nedss_row: pd.Series) -> pd.DataFrame:
     """Calculates various similarity scores and total score, then returns the score dataframe."""
     score_df = pd.DataFrame(index=nedss_df.index)
@@ -139,36 +209,274 @@ def score_record_against_records(nedss_df: pd.DataFrame, nedss_row: pd.Series) -
     return score_df
 
 
-def get_dupe_groups(adj_mat) -> List[List[int]]:
-    """Takes an adjacency matrix, applies connected components to link potential dupe records."""
-    dupe_lists = []
-    n_components, labels = sparse.csgraph.connected_components(
-            csgraph=adj_mat, directed=False, return_labels=True)
-    # get the connected components (with more than one member):
-    dupe_ids = [k for k, v in Counter(labels).items() if v > 1]
-    # for each connected component (with more than one member) find the indices for its members:
-    for dupe_id in dupe_ids:
-        dupe_lists.append([i for i, x in enumerate(labels) if x == dupe_id])
-    return dupe_lists
-
-
-def get_dupe_index_groups(data_df: pd.DataFrame, split_index: int) -> List[List[int]]:
-    """Takes dataframe to process and index first new record, and returns list of linked records"""
-    mat_dim = data_df.index.max() + 1
-    adj_mat = sparse.dok_matrix((mat_dim, mat_dim), dtype='int64')
-    new_record_indices = [i for i in data_df.index.tolist() if i >= split_index]
-    for rec_idx in tqdm(new_record_indices):
-        df_old = data_df.loc[:rec_idx - 1]
-        df_new_row = data_df.loc[rec_idx]
-        score_df = score_record_against_records(df_old, df_new_row)
-        match_df = score_df[score_df["total_score"] > 1]
-        for match_idx in match_df.index:
-            adj_mat[rec_idx, match_idx] = 1
-    return get_dupe_groups(adj_mat)
-
-
-def write_dupe_info_to_workbook(in_filepath: str, out_filepath: str, dupe_lists: List[List[int]]):
-    """Takes a list of lists of duplicate record indices, annotates input file with dupe ids."""
+def encode_strings(strings) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns strings as a matrix of their character codes, a row per string padded with zeros, and their lengths"""
+    strings = np.asarray(strings, dtype=str)
+    width = max(strings.dtype.itemsize // 4, 1)
+    codes = np.zeros((len(strings), width), dtype=np.uint32)
+    if strings.dtype.itemsize:
+        codes[:] = strings.view(np.uint32).reshape(len(strings), width)
+    return codes, np.char.str_len(strings)
+
+
+def jaro_winkler_batch(query: str, codes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Jaro-Winkler similarity of each of a batch of strings (encoded by encode_strings) to query.
+
+    Takes the same steps as textdistance.jaro_winkler(string, query), each one for the whole batch at once, in the
+    same order of arithmetic, so the results are the same to the last bit.
+    """
+    (query_codes,), (query_length,) = encode_strings([query])
+    query_codes = query_codes[:query_length]
+    n, width = codes.shape
+    weight = np.zeros(n)
+    if query_length == 0:
+        # empty matches empty, and nothing else
+        weight[lengths == 0] = 1.0
+        return weight
+
+    query_positions = np.arange(query_length)
+    search_range = np.maximum(np.maximum(lengths, query_length) // 2 - 1, 0)
+    flags = np.zeros((n, width), dtype=bool)
+    query_flags = np.zeros((n, query_length), dtype=bool)
+    # each character matches the first unmatched equal query character within search range
+    for i in range(width):
+        low = np.maximum(i - search_range, 0)
+        high = np.minimum(i + search_range, query_length - 1)
+        hits = ((query_codes == codes[:, i, None]) & ~query_flags
+                & (query_positions >= low[:, None]) & (query_positions <= high[:, None]))
+        rows = np.flatnonzero(hits.any(axis=1))
+        query_flags[rows, hits[rows].argmax(axis=1)] = True
+        flags[rows, i] = True
+    common = flags.sum(axis=1)
+
+    # transpositions: matched characters that differ between the strings, taken in order
+    matched = np.zeros((n, query_length), dtype=np.uint32)
+    query_matched = np.zeros((n, query_length), dtype=np.uint32)
+    rows, cols = np.nonzero(flags)
+    matched[rows, np.cumsum(flags, axis=1)[rows, cols] - 1] = codes[rows, cols]
+    rows, cols = np.nonzero(query_flags)
+    query_matched[rows, np.cumsum(query_flags, axis=1)[rows, cols] - 1] = query_codes[cols]
+    transpositions = (matched != query_matched).sum(axis=1) // 2
+
+    some = common > 0
+    c, t = common[some], transpositions[some]
+    jaro = c / lengths[some] + c / query_length
+    jaro += (c - t) / c
+    jaro /= 3
+    weight[some] = jaro
+
+    # winkler boost for up to 4 leading characters in common
+    prefix_length = min(query_length, 4, width)
+    same = codes[:, :prefix_length] == query_codes[:prefix_length]
+    prefix = np.minimum(np.cumprod(same, axis=1).sum(axis=1), lengths)
+    boost = weight > 0.7
+    weight[boost] += prefix[boost] * 0.1 * (1.0 - weight[boost])
+    return weight
+
+
+# phonetic column -> (score column, how similar counts as a match), as in the similarity scorers
+STRING_SCORES = {
+    "phonetic_first_name": ("first_name_similarity_score", 0.8),
+    "phonetic_last_name": ("last_name_similarity_score", 0.8),
+    "phonetic_address": ("address_similarity_score", 0.9),
+}
+
+
+def as_int(value):
+    """value as an int the way age_similarity_scorer casts it, or None if it can't be"""
+    try:
+        return int(value)
+    except:
+        return None
+
+
+def encode_records(nedss_df: pd.DataFrame) -> Dict[str, object]:
+    """Turns the preprocessed columns scoring uses into arrays for score_record_batch, once for all comparisons"""
+    ages = [as_int(age) for age in nedss_df["Age"]]
+    gender = nedss_df["Gender"].to_numpy(dtype=object)
+    records = {column: (nedss_df[column].to_numpy(dtype=object),) + encode_strings(nedss_df[column])
+               for column in STRING_SCORES}
+    return {
+        **records,
+        "Age": np.array([np.nan if age is None else age for age in ages], dtype=float),
+        "Gender": gender,
+        "blank_gender": np.array([g is None or g == "" for g in gender], dtype=bool),
+    }
+
+
+def score_record_batch(records: Dict[str, object], position: int, candidates) -> Dict[str, np.ndarray]:
+    """Scores the record at position against the candidates (positions or a slice) of records from encode_records.
+
+    Returns the same scores as score_record_against_records, as arrays.
+    """
+    scores = {}
+    for column, (score, threshold) in STRING_SCORES.items():
+        values, codes, lengths = records[column]
+        similarity = jaro_winkler_batch(values[position], codes[candidates], lengths[candidates])
+        scores[score] = (similarity > threshold).astype('int64')
+    ages = records["Age"]
+    scores["age_similarity_score"] = np.where(np.abs(ages[candidates] - ages[position]) > 2, -1, 0)
+    gender = records["Gender"]
+    blank = records["blank_gender"]
+    matches = (gender[candidates] == gender[position]) | blank[candidates] | blank[position]
+    scores["gender_similarity_score"] = np.where(matches, 0, -1)
+    scores["total_score"] = sum(scores.values())
+    return scores
+
+
+class DisjointSet:
+    """Union-find over record indices, linking matches into dupe groups as they are found.
+
+    Only the records in a match take up room. With keep_edges, the matches are kept too, with their scores, for
+    audit.
+    """
+
+    def __init__(self, keep_edges: bool = False):
+        self.parent = {}
+        self.edges = [] if keep_edges else None
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # point the whole path at the root, so the next find is quick
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, a: int, b: int, score: int = None):
+        a, b = int(a), int(b)
+        self.parent.setdefault(a, a)
+        self.parent.setdefault(b, b)
+        root_a, root_b = self.find(a), self.find(b)
+        # the lowest index is the root of its group
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+        if self.edges is not None:
+            self.edges.append((a, b, score))
+
+    def groups(self) -> List[List[int]]:
+        """The linked records, each group in index order, the groups in order of their first record"""
+        groups = {}
+        for i in sorted(self.parent):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+
+def match_positions(records: Dict[str, object], labels: np.ndarray, blocks, positions) -> List[Tuple[int, int]]:
+    """(new record index, earlier record index, total score) for each match of the records at positions"""
+    edges = []
+    for position in positions:
+        candidates = earlier_candidates(blocks, position)
+        scores = score_record_batch(records, position, candidates)
+        matches = scores["total_score"] > 1
+        edges += [(labels[position], match_idx, score)
+                  for match_idx, score in zip(labels[candidates][matches], scores["total_score"][matches])]
+    return edges
+
+
+# what worker processes score against, set once per worker by share
+_shared = {}
+
+
+def share(records: Dict[str, object], labels: np.ndarray, blocks):
+    _shared.update(records=records, labels=labels, blocks=blocks)
+
+
+def score_shard(positions) -> List[Tuple[int, int]]:
+    return match_positions(_shared["records"], _shared["labels"], _shared["blocks"], positions)
+
+
+def pool_context():
+    # fork on Linux, so workers inherit the records instead of having them pickled over. Elsewhere the platform's
+    # default: macOS has fork, but forking there isn't safe with the system libraries' threads
+    if sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def get_match_edges(data_df: pd.DataFrame, split_index: int, block_keys: List[str] = DEFAULT_BLOCK_KEYS,
+                    workers: int = None):
+    """Yields (new record index, earlier record index, total score) for each match of a new record, see
+    candidate_positions.
+
+    With several workers, the new records are scored in shards of SHARD_SIZE across a process pool. The edges come
+    out in the same order either way.
+    """
+    labels = data_df.index.to_numpy()
+    records = encode_records(data_df)
+    blocks = None if block_keys is None else block_groups(data_df, block_keys)
+    positions = new_positions(data_df, split_index)
+    if not workers or workers < 2 or len(positions) < 2:
+        for position in tqdm(positions):
+            yield from match_positions(records, labels, blocks, [position])
+        return
+
+    # The records go to each worker once, as it starts: with fork they are inherited, not pickled at all.
+    # Shards are small so later records, which have more to be compared with, spread evenly over the workers,
+    # and map returns them in order.
+    shards = [positions[i:i + SHARD_SIZE] for i in range(0, len(positions), SHARD_SIZE)]
+    with ProcessPoolExecutor(workers, mp_context=pool_context(), initializer=share,
+                             initargs=(records, labels, blocks)) as pool, tqdm(total=len(positions)) as progress:
+        for shard, edges in zip(shards, pool.map(score_shard, shards)):
+            progress.update(len(shard))
+            yield from edges
+
+
+def link_matches(data_df: pd.DataFrame, split_index: int, block_keys: List[str] = DEFAULT_BLOCK_KEYS,
+                 workers: int = None, keep_edges: bool = False) -> DisjointSet:
+    """Links each new record with its matches, see get_dupe_index_groups. With keep_edges, the DisjointSet also
+    keeps the matches with their scores.
+    """
+    linked = DisjointSet(keep_edges)
+    for rec_idx, match_idx, score in get_match_edges(data_df, split_index, block_keys, workers):
+        linked.union(rec_idx, match_idx, int(score))
+    return linked
+
+
+def get_dupe_index_groups(data_df: pd.DataFrame, split_index: int, block_keys: List[str] = DEFAULT_BLOCK_KEYS,
+                          workers: int = None) -> List[List[int]]:
+    """Takes dataframe to process and index first new record, and returns list of linked records.
+
+    New records are compared with the earlier records sharing a block key with them, or all earlier records if
+    block_keys is None, across workers processes if more than one.
+    """
+    return link_matches(data_df, split_index, block_keys, workers).groups()
+
+
+def blocking_report(data_df: pd.DataFrame, split_index: int, block_keys: List[str] = DEFAULT_BLOCK_KEYS,
+                    recall: bool = False, workers: int = None) -> dict:
+    """Counts the record pairs blocking leaves to score, out of all the pairs of new and earlier records.
+
+    With recall, also scores all the pairs to count how many of their matches blocking keeps, which takes as long
+    as an exhaustive run.
+    """
+    new_records = all_pairs = candidate_pairs = 0
+    for position, candidates in candidate_positions(data_df, split_index, block_keys):
+        new_records += 1
+        all_pairs += position
+        # exhaustive mode compares with every earlier record, as a slice
+        candidate_pairs += position if isinstance(candidates, slice) else len(candidates)
+    report = {
+        "new_records": new_records,
+        "all_pairs": all_pairs,
+        "candidate_pairs": candidate_pairs,
+        "reduction_ratio": 1 - candidate_pairs / all_pairs if all_pairs else 0.0
+    }
+    if recall:
+        matches = {edge[:2] for edge in get_match_edges(data_df, split_index, None, workers)}
+        kept = {edge[:2] for edge in get_match_edges(data_df, split_index, block_keys, workers)}
+        report["matches"] = len(matches)
+        report["matches_kept"] = len(kept & matches)
+        report["recall"] = report["matches_kept"] / len(matches) if matches else 1.0
+    return report
+
+
+def write_dupe_info_to_workbook(in_filepath: str, out_filepath: str, dupe_lists: List[List[int]], group_ids: List = None):
+    """Takes a list of lists of duplicate record indices, annotates input file with dupe ids.
+
+    The ids are the groups' positions in dupe_lists, or group_ids when given.
+    """
     wb = xl.load_workbook(in_filepath)
     ws = wb.worksheets[0]
     new_col_idx = ws.max_column + 1
@@ -176,7 +484,7 @@ def write_dupe_info_to_workbook(in_filepath: str, out_filepath: str, dupe_lists:
     for i, dupe_group in enumerate(dupe_lists):
         for dupe in dupe_group:
             # +2 for header and 1-index offset
-            ws.cell(row=dupe + 2, column=new_col_idx, value=i)
+            ws.cell(row=dupe + 2, column=new_col_idx, value=group_ids[i] if group_ids else i)
     if not out_filepath:
         out_filepath = in_filepath.split(".")
         out_filepath[-2] = out_filepath[-2] + "_w_DUPE_UUID"
@@ -184,7 +492,18 @@ def write_dupe_info_to_workbook(in_filepath: str, out_filepath: str, dupe_lists:
     wb.save(out_filepath)
 
 
+def write_match_edges(out_filepath: str, data_df: pd.DataFrame, edges: List[Tuple[int, int, int]]):
+    """Saves each match with its score as a CSV, by Identifier, for auditing the dupe groups"""
+    records, matches, scores = zip(*edges) if edges else ((), (), ())
+    pd.DataFrame({
+        "Identifier": data_df.loc[list(records), "Identifier"].to_numpy(),
+        "Match Identifier": data_df.loc[list(matches), "Identifier"].to_numpy(),
+        "Score": list(scores)
+    }).to_csv(out_filepath, index=False)
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     arg_parser = argparse.ArgumentParser(description='Flag NEDSS data for review')
     arg_parser.add_argument('-p',
                             '--path',
@@ -200,13 +519,38 @@ if __name__ == "__main__":
                             '--output',
                             type=str,
                             help='where to save the output file')
+    arg_parser.add_argument('-b',
+                            '--block-keys',
+                            nargs='+',
+                            choices=sorted(BLOCK_KEYS),
+                            default=DEFAULT_BLOCK_KEYS,
+                            help='only compare records sharing one of these keys (default: {})'.format(
+                                ' '.join(DEFAULT_BLOCK_KEYS)))
+    arg_parser.add_argument('--exhaustive',
+                            action='store_true',
+                            help='compare each new record with every earlier record')
+    arg_parser.add_argument('--recall',
+                            action='store_true',
+                            help='also compare all pairs, to report how many of their matches blocking keeps')
+    arg_parser.add_argument('-w',
+                            '--workers',
+                            type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='processes to score new records with (default: one per CPU)')
+    arg_parser.add_argument('--edges',
+                            type=str,
+                            help='also save every match with its score to this CSV file')
+    arg_parser.add_argument('--index',
+                            type=str,
+                            help='dedup index (SQLite file) to score the file against and then add it to, so the file '
+                                 'only needs the new records; created from the file if it does not exist')
     args = arg_parser.parse_args()
 
     path = args.path
     output = args.output
     identifier = args.identifier
 
-    if not path or not output or not identifier:
+    if not path or not output or not (identifier or args.index):
         path = input("Paste the input file path here (then press enter): ")
         path = path.strip('"')
         output = input("Paste the output file path here (then press enter): ")
@@ -219,8 +563,33 @@ if __name__ == "__main__":
         identifier = int(identifier)
 
     df = pd.read_excel(path)
-    df = preprocess(df)  # do all up-front preprocessing here (e.g., phonetics)
-    index_of_first_new_record = df[df["Identifier"] == identifier].index[0]
-    dupe_groups = get_dupe_index_groups(df, index_of_first_new_record)
-
-    write_dupe_info_to_workbook(path, output, dupe_groups)
+    block_keys = None if args.exhaustive else args.block_keys
+    if args.index:
+        from dedup_index import DedupIndex
+
+        with DedupIndex(args.index) as index:
+            # a new index can start from a cumulative file, the records before identifier being its history
+            df.columns = df.columns.str.strip()
+            indexed = len(index)
+            index_of_first_new_record = None
+            if identifier and not indexed:
+                index_of_first_new_record = df[df["Identifier"] == identifier].index[0]
+            positions = index.add(df, block_keys, args.workers, index_of_first_new_record)
+            print("Added {} records to the index, which now holds {}".format(len(index) - indexed, len(index)))
+            dupe_groups, group_ids = index.groups(positions)
+        write_dupe_info_to_workbook(path, output, dupe_groups, group_ids)
+    else:
+        df = preprocess(df)  # do all up-front preprocessing here (e.g., phonetics)
+        index_of_first_new_record = df[df["Identifier"] == identifier].index[0]
+        linked = link_matches(df, index_of_first_new_record, block_keys, args.workers, keep_edges=bool(args.edges))
+        dupe_groups = linked.groups()
+        if args.edges:
+            write_match_edges(args.edges, df, linked.edges)
+
+        report = blocking_report(df, index_of_first_new_record, block_keys, args.recall and not args.exhaustive,
+                                 args.workers)
+        print("Compared {candidate_pairs} of {all_pairs} record pairs (reduction ratio {reduction_ratio:.4f})".format(
+                **report))
+        if "recall" in report:
+            print("Blocking kept {matches_kept} of {matches} matches (recall {recall:.4f})".format(**report))
+        write_dupe_info_to_workbook(path, output, dupe_groups)
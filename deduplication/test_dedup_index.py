@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import nedss_duplicate_finder as nedss
+from dedup_index import DedupIndex, IndexVersionError
+
+
+# NOTE: John/Jon McDermid and Mario/Maria Battali are the same people
+d = {'Identifier': [101, 102, 103, 104, 105, 106, 107],
+     'First Name': ["John", "Cindy", "Mario", "Albert", "Jon", "Maria", "Cindy"],
+     'Last Name ': ["McDermid", "McCain", "Battali", "Einstein", "McDermit", "Batali", "Lauper"],
+     'Address': ["35 Main St.", "42 Overlook Dr.", "103 Broadway", "88 Random House", "35 Mane Streat",
+                 "103 Brodway", "7 Elm St."],
+     'Age': [42, 88, 23, np.nan, 41, "unknown", 60],
+     'Gender': ["M", "F", np.nan, "M", "M", np.nan, None]}
+
+
+@pytest.mark.parametrize("block_keys", [nedss.DEFAULT_BLOCK_KEYS, None])
+def test_batches_added_to_index_group_like_a_single_run(tmp_path, block_keys):
+    df = pd.DataFrame(data=d)
+    whole = nedss.get_dupe_index_groups(nedss.preprocess(df.copy()), 2, block_keys)
+
+    with DedupIndex(str(tmp_path / "index.sqlite")) as index:
+        index.add(df.iloc[:2].copy(), block_keys, split_index=2)
+        index.add(df.iloc[2:5].copy(), block_keys)
+    # reopened, the stored history and groups carry on
+    with DedupIndex(str(tmp_path / "index.sqlite")) as index:
+        positions = index.add(df.iloc[5:].copy(), block_keys)
+        assert positions.tolist() == [5, 6]
+        dupe_lists, group_ids = index.groups(positions)
+        assert (dupe_lists, group_ids) == ([[5]], [103])
+        assert index.groups(pd.Series(range(7)))[0] == whole
+        assert len(index) == 7
+
+
+def test_index_skips_records_it_already_has(tmp_path):
+    df = pd.DataFrame(data=d)
+    with DedupIndex(str(tmp_path / "index.sqlite")) as index:
+        index.add(df.iloc[:5].copy())
+        positions = index.add(df.copy())
+        assert positions.tolist() == list(range(7))
+        assert len(index) == 7
+        assert index.groups(positions) == ([[0, 4], [2, 5]], [101, 103])
+
+
+def test_index_keeps_missing_genders_apart_from_blank_ones(tmp_path):
+    df = pd.DataFrame(data=d)
+    with DedupIndex(str(tmp_path / "index.sqlite")) as index:
+        index.add(df.copy())
+        records = index.candidates(nedss.preprocess(df.copy()), None)
+    assert np.isnan(records.loc[2, "Gender"]) and records.loc[6, "Gender"] is None
+    assert records["Age"].tolist()[:3] == [42, 88, 23]
+
+
+def test_index_from_another_version_is_refused(tmp_path):
+    path = str(tmp_path / "index.sqlite")
+    with DedupIndex(path) as index:
+        with index.connection:
+            index.set_meta("version", 0)
+    with pytest.raises(IndexVersionError):
+        DedupIndex(path)
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import pytest
 import textdistance
@@ -79,3 +80,86 @@ def test_mini_pipeline():
     df = nedss.preprocess(df)
     dupe_groups = nedss.get_dupe_index_groups(df, 3)
     assert dupe_groups == [[0, 4]]
+
+
+def test_mini_pipeline_exhaustive():
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    assert nedss.get_dupe_index_groups(df, 3, block_keys=None) == [[0, 4]]
+
+
+def test_candidates_share_a_block_key_with_the_new_record():
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    candidates = dict(nedss.candidate_positions(df, 3, ["first_last", "last_name"]))
+    # Jon McDermit blocks with John McDermid, and by last name prefix with Cindy McCain
+    assert candidates[4].tolist() == [0, 1]
+    assert candidates[3].tolist() == []
+    assert dict(nedss.candidate_positions(df, 3, None))[4] == slice(0, 4)
+
+
+def test_blocking_report_counts_pairs_left_to_score():
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    report = nedss.blocking_report(df, 3, ["first_last", "last_name"], recall=True)
+    assert (report["new_records"], report["all_pairs"], report["candidate_pairs"]) == (2, 7, 2)
+    assert report["reduction_ratio"] == pytest.approx(5 / 7)
+    assert (report["matches"], report["matches_kept"], report["recall"]) == (1, 1, 1.0)
+
+
+def test_jaro_winkler_batch_matches_textdistance():
+    words = ["", "A", "JN", "JHN", "MKTRMT", "MKTRT", "MRS", "RMRS", "MN ST", "MN STRT", "SNTR PK", "STR PK",
+             "KMPL", "KMPBL", "XKLFRT", "XLKFRT", "TWN", "TN"]
+    codes, lengths = nedss.encode_strings(words)
+    for query in words:
+        expected = [textdistance.jaro_winkler(word, query) for word in words]
+        assert nedss.jaro_winkler_batch(query, codes, lengths).tolist() == expected
+
+
+def test_score_record_batch_matches_reference_scorers():
+    df = pd.DataFrame(data={'First Name': ["John", "Cindy", "", "Albert", "Jon", "Jhon"],
+                            'Last Name': ["McDermid", "McCain", "Battali", "", "McDermit", "MacDermid"],
+                            'Address': ["35 Main St.", "42 Overlook Dr.", "103 Broadway", "", "35 Mane Streat", "35 Main"],
+                            'Age': [42, "unknown", 23, None, 41, 44.5],
+                            'Gender': ["M", "F", None, "", "M", "F"]})
+    df = nedss.preprocess(df)
+    records = nedss.encode_records(df)
+    for position in range(len(df)):
+        expected = nedss.score_record_against_records(df, df.iloc[position])
+        scores = nedss.score_record_batch(records, position, np.arange(len(df)))
+        for column in expected.columns:
+            assert scores[column].tolist() == expected[column].tolist()
+
+
+def test_parallel_scoring_matches_serial(monkeypatch):
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    monkeypatch.setattr(nedss, "SHARD_SIZE", 1)
+    for block_keys in (nedss.DEFAULT_BLOCK_KEYS, None):
+        serial = list(nedss.get_match_edges(df, 1, block_keys))
+        assert list(nedss.get_match_edges(df, 1, block_keys, workers=2)) == serial
+    assert nedss.get_dupe_index_groups(df, 1, workers=2) == [[0, 4]]
+
+
+def test_disjoint_set_groups_linked_records_in_order():
+    linked = nedss.DisjointSet(keep_edges=True)
+    for a, b, score in [(9, 7, 2), (12, 3, 3), (7, 3, 2), (20, 15, 2)]:
+        linked.union(a, b, score)
+    assert linked.groups() == [[3, 7, 9, 12], [15, 20]]
+    assert linked.edges == [(9, 7, 2), (12, 3, 3), (7, 3, 2), (20, 15, 2)]
+    assert nedss.DisjointSet().edges is None
+
+
+def test_link_matches_keeps_scored_edges():
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    linked = nedss.link_matches(df, 3, keep_edges=True)
+    assert linked.groups() == [[0, 4]]
+    assert linked.edges == [(4, 0, 3)]
+
+
+def test_blocking_report_in_exhaustive_mode_counts_every_pair():
+    df = pd.DataFrame(data=d)
+    df = nedss.preprocess(df)
+    report = nedss.blocking_report(df, 3, None)
+    assert (report["all_pairs"], report["candidate_pairs"], report["reduction_ratio"]) == (7, 7, 0.0)
@@ -1,24 +1,113 @@
+import hashlib
+import json
+import os
+import stat
+
 import pandas as pd
 
-def fields(rules_file):
-    # for multi-sheet workbooks, pandas' pd.read_excel(...) method expects a sheet name to be passed.
-    # Instead we'll use pd.ExcelFile(...) to read the file and get access to the contained sheet names.
-    xl = pd.ExcelFile(rules_file)
+# Compiled rules are cached in cache_dir as JSON, keyed by a hash of the rules file's content, so an unchanged rules
+# file isn't read again. Any change to the file compiles every sheet again.
+CACHE_VERSION = 2
+
+
+def compile_sheet(df):
+    allowed_set = set(df["Allowed Values"]) - {""}
+    autocorrect_dict = dict(zip(df["Invalid Value"], df["Corrected Value"]))
+    autocorrect_dict = {k: v for k, v in autocorrect_dict.items() if v != ""}
+
+    return {
+        "allowed_value_set": allowed_set,
+        "autocorrect_dict" : autocorrect_dict
+    }
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def user_cache_dir():
+    """The current user's cache folder for compiled rules"""
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'spreadsheet-cleaner')
+
+
+def private_dir(path):
+    """Creates path readable only by the current user, if it doesn't exist. Returns whether nobody else can write
+    to it, as a cache anybody could write to could hand out doctored rules
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name == 'nt':
+        # folders under the user's profile are private already
+        return True
+    info = os.stat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def cache_path(rules_file, cache_dir):
+    # one cache file per rules file location
+    name = hashlib.sha1(os.path.abspath(rules_file).encode()).hexdigest()
+    return os.path.join(cache_dir, "rules-{}.json".format(name))
+
+
+def read_cache(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except Exception:
+        return None
+    return cache if cache.get("version") == CACHE_VERSION else None
+
+
+def write_cache(path, cache):
+    try:
+        content = json.dumps(cache)
+    except TypeError:
+        # values JSON can't hold (dates and the like) are compiled every time instead
+        return
+    # written aside, then swapped in, so a half written cache is never read
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def to_json(compiled):
+    # the set becomes a list and the dict a list of pairs, as JSON has no sets and only text keys
+    return {"allowed_value_set": list(compiled["allowed_value_set"]),
+            "autocorrect_dict": list(compiled["autocorrect_dict"].items())}
+
+
+def from_json(cached):
+    return {"allowed_value_set": set(cached["allowed_value_set"]),
+            "autocorrect_dict": dict(map(tuple, cached["autocorrect_dict"]))}
+
+
+def fields(rules_file, cache_dir=None):
+    # Every sheet is read in one pass over the workbook: sheet_name=None returns them all, in workbook order.
+    # With a cache_dir (one only the current user can write to, see private_dir), an unchanged rules file isn't
+    # read at all.
+    path = content_hash = None
+    if cache_dir and private_dir(cache_dir):
+        path = cache_path(rules_file, cache_dir)
+        content_hash = file_hash(rules_file)
+        cache = read_cache(path)
+        if cache and cache["hash"] == content_hash:
+            return {sheet_name: from_json(compiled) for sheet_name, compiled in cache["sheets"]}
+
+    sheets = pd.read_excel(rules_file, sheet_name=None, keep_default_na=False)
 
     fields = {}  # making a tmp dict to collect outputs for inspection.
+    for sheet_name, df in sheets.items():
+        fields[sheet_name] = compile_sheet(df)
 
-    for sheet_name in xl.sheet_names:
-        df = pd.read_excel(rules_file, sheet_name=sheet_name, keep_default_na=False)
-        allowed_set = set(df["Allowed Values"]) - {""}
-        autocorrect_dict = dict(zip(df["Invalid Value"], df["Corrected Value"]))
-        autocorrect_dict = {k: v for k, v in autocorrect_dict.items() if v != ""}
+    if path:
+        # sheets as a list of pairs, to keep the workbook order
+        write_cache(path, {"version": CACHE_VERSION, "hash": content_hash,
+                           "sheets": [[sheet_name, to_json(compiled)] for sheet_name, compiled in fields.items()]})
 
-        # throwing these in a dict for storage - they could be written to CSV here instead:
-        fields[sheet_name] = {
-            "allowed_value_set": allowed_set,
-            "autocorrect_dict" : autocorrect_dict
-        }
-  
     return fields
 
 '''
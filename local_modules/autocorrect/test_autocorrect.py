@@ -0,0 +1,61 @@
+import os
+
+import pandas as pd
+import pytest
+
+from local_modules.autocorrect import autocorrect
+
+
+def write_rules(path, sheets):
+    with pd.ExcelWriter(path) as writer:
+        for name, rows in sheets.items():
+            pd.DataFrame(rows, columns=["Allowed Values", "Invalid Value", "Corrected Value"]) \
+                .to_excel(writer, sheet_name=name, index=False)
+
+
+gender = [["M", "male", "M"], ["F", "Female", "F"], ["Unknown", "unk", "Unknown"], ["Other", None, None]]
+race = [["White", None, None], ["Asian", None, None]]
+
+
+def test_fields_reads_every_sheet(tmp_path):
+    rules_file = tmp_path / "rules.xlsx"
+    write_rules(rules_file, {"Gender": gender, "Race": race})
+    rules = autocorrect.fields(str(rules_file))
+    assert list(rules) == ["Gender", "Race"]
+    assert rules["Gender"]["allowed_value_set"] == {"M", "F", "Unknown", "Other"}
+    assert rules["Gender"]["autocorrect_dict"] == {"male": "M", "Female": "F", "unk": "Unknown"}
+    assert rules["Race"]["autocorrect_dict"] == {}
+
+
+def test_fields_cache_skips_unchanged_rules_file(tmp_path, monkeypatch):
+    rules_file = tmp_path / "rules.xlsx"
+    cache_dir = str(tmp_path / "cache")
+    write_rules(rules_file, {"Gender": gender, "Race": race, "Zip": [[10001, 1001, 10001]]})
+    compiled = autocorrect.fields(str(rules_file), cache_dir)
+
+    calls = []
+    compile_sheet = autocorrect.compile_sheet
+    monkeypatch.setattr(autocorrect, "compile_sheet", lambda df: calls.append(df) or compile_sheet(df))
+    cached = autocorrect.fields(str(rules_file), cache_dir)
+    assert cached == compiled and list(cached) == ["Gender", "Race", "Zip"]
+    assert calls == []
+
+    write_rules(rules_file, {"Gender": gender, "Race": race + [["Black or African American", None, None]]})
+    rules = autocorrect.fields(str(rules_file), cache_dir)
+    assert len(calls) == 2
+    assert "Black or African American" in rules["Race"]["allowed_value_set"]
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="folder permissions are ACLs on Windows")
+def test_fields_ignores_cache_others_can_write_to(tmp_path):
+    rules_file = tmp_path / "rules.xlsx"
+    cache_dir = tmp_path / "cache"
+    write_rules(rules_file, {"Gender": gender})
+    cache_dir.mkdir()
+    cache_dir.chmod(0o777)
+    autocorrect.fields(str(rules_file), str(cache_dir))
+    assert list(cache_dir.iterdir()) == []
+
+    private = tmp_path / "private"
+    autocorrect.fields(str(rules_file), str(private))
+    assert private.stat().st_mode & 0o777 == 0o700
@@ -0,0 +1,321 @@
+"""Synthetic spreadsheet generator.
+
+Makes data shaped like ours without any real PHI: every column of a rules file (see autocorrect.fields), mostly
+holding allowed values, with a tunable share of values autocorrect should fix and of unknown values that should
+be flagged, next to NEDSS-style person records (First Name, Last Name, Address, Age, Gender) that include
+duplicates of earlier records with typos.
+
+Alongside the data it writes the ground truth: <name>.labels.csv lists every cell that should be corrected or
+flagged, and <name>.duplicates.csv every record that duplicates an earlier one. Rows are numbered from 0, in the
+order of the data. Output is written a batch at a time, so files of any size fit in memory.
+
+Example:
+
+    py datagen.py -r sample.rules.xlsx -n 1000000 -o synthetic.parquet --seed 7
+
+"""
+
+import argparse  # for command line arg parsing
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+AUTOCORRECT_RATE = 0.05
+UNKNOWN_RATE = 0.01
+DUPLICATE_RATE = 0.05
+NULL_RATE = 0.0
+
+# earlier records kept to copy duplicates from
+HISTORY = 100000
+
+PERSON_COLUMNS = ['Identifier', 'First Name', 'Last Name', 'Address', 'Age', 'Gender']
+TYPO_COLUMNS = ['First Name', 'Last Name', 'Address']
+LABEL_COLUMNS = ['Row', 'Column', 'Value', 'Label', 'Expected']
+DUPLICATE_COLUMNS = ['Row', 'Duplicate Of']
+
+# labels for cells clean should change
+CORRECTED = 'corrected'
+FLAGGED = 'flagged'
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'William', 'Elizabeth', 'David',
+    'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen', 'Christopher', 'Nancy',
+    'Daniel', 'Lisa', 'Matthew', 'Betty', 'Anthony', 'Margaret', 'Mark', 'Sandra', 'Donald', 'Ashley', 'Steven',
+    'Kimberly', 'Paul', 'Emily', 'Andrew', 'Donna', 'Joshua', 'Michelle', 'Kenneth', 'Dorothy', 'Kevin', 'Carol',
+    'Brian', 'Amanda', 'George', 'Melissa', 'Edward', 'Deborah', 'Ronald', 'Stephanie', 'Timothy', 'Rebecca', 'Jason',
+    'Sharon', 'Jeffrey', 'Laura', 'Ryan', 'Cynthia', 'Jacob', 'Kathleen', 'Gary', 'Amy', 'Nicholas', 'Shirley', 'Eric',
+    'Angela', 'Jonathan', 'Helen', 'Stephen', 'Anna', 'Larry', 'Brenda', 'Justin', 'Pamela', 'Scott', 'Nicole',
+    'Brandon', 'Emma', 'Benjamin', 'Samantha', 'Samuel', 'Katherine', 'Gregory', 'Christine', 'Frank', 'Debra',
+    'Alexander', 'Rachel', 'Raymond', 'Catherine', 'Patrick', 'Carolyn', 'Jack', 'Janet', 'Dennis', 'Ruth', 'Jerry',
+    'Maria', 'Tyler', 'Heather', 'Aaron', 'Diane', 'Jose', 'Virginia', 'Adam', 'Julie', 'Henry', 'Joyce', 'Nathan',
+    'Victoria', 'Douglas', 'Olivia', 'Zachary', 'Kelly', 'Peter', 'Christina', 'Kyle', 'Lauren', 'Walter', 'Joan',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee',
+    'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson', 'Walker', 'Young',
+    'Allen', 'King', 'Wright', 'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores', 'Green', 'Adams', 'Nelson', 'Baker',
+    'Hall', 'Rivera', 'Campbell', 'Mitchell', 'Carter', 'Roberts', 'Gomez', 'Phillips', 'Evans', 'Turner', 'Diaz',
+    'Parker', 'Cruz', 'Edwards', 'Collins', 'Reyes', 'Stewart', 'Morris', 'Morales', 'Murphy', 'Cook', 'Rogers',
+    'Gutierrez', 'Ortiz', 'Morgan', 'Cooper', 'Peterson', 'Bailey', 'Reed', 'Kelly', 'Howard', 'Ramos', 'Kim', 'Cox',
+    'Ward', 'Richardson', 'Watson', 'Brooks', 'Chavez', 'Wood', 'James', 'Bennett', 'Gray', 'Mendoza', 'Ruiz',
+    'Hughes', 'Price', 'Alvarez', 'Castillo', 'Sanders', 'Patel', 'Myers', 'Long', 'Ross', 'Foster', 'Jimenez',
+]
+STREETS = [
+    'Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill', 'Walnut', 'Spring', 'North',
+    'Ridge', 'Church', 'Willow', 'Mill', 'Sunset', 'Railroad', 'Jackson', 'Cherry', 'Highland', 'Park', 'Spooner',
+    'Lincoln', 'Franklin', 'Center', 'Forest', 'Jefferson', 'Chestnut', 'Meadow', 'Madison', 'Broad', 'Valley',
+    'Overlook', 'Broadway', 'Market', 'Poplar', 'Locust', 'Dogwood', 'Birch', 'Lancaster', 'Germantown', 'Butler',
+]
+STREET_TYPES = ['St.', 'Ave.', 'Rd.', 'Dr.', 'Ln.', 'Blvd.', 'Ct.', 'Pike']
+GENDERS = ['M', 'F']
+
+
+def typo(rng, text):
+    """Returns text with one random typo: a letter dropped, doubled, swapped with the next or replaced.
+
+    The typo always changes text: swapping two equal letters drops one instead, and a replaced letter is never
+    replaced with itself.
+    """
+    if len(text) < 2:
+        return text + text
+    i = int(rng.integers(0, len(text) - 1))
+    kind = rng.integers(0, 4)
+    if kind == 2 and text[i] == text[i + 1]:
+        kind = 0
+    if kind == 0:
+        return text[:i] + text[i + 1:]
+    if kind == 1:
+        return text[:i] + text[i] + text[i:]
+    if kind == 2:
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    letters = [letter for letter in string.ascii_lowercase if letter != text[i]]
+    return text[:i] + letters[int(rng.integers(0, len(letters)))] + text[i + 1:]
+
+
+class Column:
+    """What to draw for one rule column: allowed values, values autocorrect fixes, and values nobody allows"""
+    def __init__(self, field, rule):
+        self.field = field
+        allowed = rule['allowed_value_set']
+        self.nullable = 'NULL' in allowed
+        self.allowed = sorted(allowed - {'NULL'}, key=str)
+        # only values autocorrect turns into something allowed, so each one is corrected and not flagged
+        self.corrections = {invalid: corrected for invalid, corrected in rule['autocorrect_dict'].items()
+                            if invalid not in allowed and corrected in allowed}
+        self.correctable = sorted(self.corrections, key=str)
+        # unknown values of the column's own type, so columns of numbers stay numbers
+        numeric = bool(self.allowed) and all(isinstance(value, (int, np.integer)) for value in self.allowed)
+        self.unknown = (lambda n: max(self.allowed) + 1 + n) if numeric else (lambda n: "Unknown {} {}".format(field, n))
+
+    def draw(self, rng, rows, autocorrect_rate, unknown_rate, null_rate):
+        values = np.empty(rows, dtype=object)
+        values[:] = np.array(self.allowed or ['NULL'], dtype=object)[rng.integers(0, max(len(self.allowed), 1), rows)]
+        draw = rng.random(rows)
+        if self.correctable:
+            fix = draw < autocorrect_rate
+            values[fix] = np.array(self.correctable, dtype=object)[rng.integers(0, len(self.correctable), fix.sum())]
+        unknown = np.flatnonzero(draw >= 1 - unknown_rate)
+        values[unknown] = [self.unknown(int(n)) for n in rng.integers(0, 1000, len(unknown))]
+        missing = (draw >= autocorrect_rate) & (draw < autocorrect_rate + null_rate)
+        values[missing] = None
+        return values
+
+    def labels(self, values, start):
+        """Label rows for the cells of values (a Series indexed by row) that clean should correct or flag"""
+        missing = values.isna()
+        corrected = values.isin(self.correctable) & ~missing
+        flagged = ~values.isin(self.allowed) & ~corrected & (~missing | (not self.nullable))
+        labels = pd.Series(None, index=values.index, dtype=object)
+        labels[corrected] = CORRECTED
+        labels[flagged] = FLAGGED
+        keep = labels.notna()
+        return pd.DataFrame({
+            'Row': values.index[keep] + start,
+            'Column': self.field,
+            'Value': values[keep].values,
+            'Label': labels[keep].values,
+            'Expected': values[keep].map(self.corrections).values
+        })
+
+
+class Generator:
+    """Draws batches of synthetic rows for a set of rules (from autocorrect.fields), reproducible from seed"""
+    def __init__(self, rules, seed=0, autocorrect_rate=AUTOCORRECT_RATE, unknown_rate=UNKNOWN_RATE,
+                 duplicate_rate=DUPLICATE_RATE, null_rate=NULL_RATE):
+        self.rng = np.random.default_rng(seed)
+        self.columns = [Column(field, rule) for field, rule in rules.items()]
+        self.autocorrect_rate = autocorrect_rate
+        self.unknown_rate = unknown_rate
+        self.duplicate_rate = duplicate_rate
+        self.null_rate = null_rate
+        self.rows = 0
+        # the latest records, to copy duplicates from
+        self.history = {field: [] for field in PERSON_COLUMNS}
+
+    def people(self, rows):
+        rng = self.rng
+        return pd.DataFrame({
+            'Identifier': np.arange(self.rows + 1, self.rows + rows + 1),
+            'First Name': np.array(FIRST_NAMES, dtype=object)[rng.integers(0, len(FIRST_NAMES), rows)],
+            'Last Name': np.array(LAST_NAMES, dtype=object)[rng.integers(0, len(LAST_NAMES), rows)],
+            'Address': pd.Series(rng.integers(1, 10000, rows)).astype(str).values + ' ' +
+                       np.array(STREETS, dtype=object)[rng.integers(0, len(STREETS), rows)] + ' ' +
+                       np.array(STREET_TYPES, dtype=object)[rng.integers(0, len(STREET_TYPES), rows)],
+            'Age': rng.integers(0, 100, rows),
+            'Gender': np.array(GENDERS, dtype=object)[rng.integers(0, len(GENDERS), rows)],
+        })
+
+    def batch(self, rows):
+        """Returns the next rows rows of data, with their cell labels and duplicates"""
+        rng = self.rng
+        start = self.rows
+        df = self.people(rows)
+        for column in self.columns:
+            df[column.field] = column.draw(rng, rows, self.autocorrect_rate, self.unknown_rate, self.null_rate)
+
+        # duplicates copy an earlier record (from an earlier batch or earlier in this one) with typos
+        people = {field: df[field].tolist() for field in PERSON_COLUMNS}
+        earlier = len(self.history['Identifier'])
+        duplicates = []
+        for i in np.flatnonzero(rng.random(rows) < self.duplicate_rate):
+            if earlier + i == 0:
+                continue
+            j = int(rng.integers(0, earlier + i))
+            source, k = (self.history, j) if j < earlier else (people, j - earlier)
+            for field in ('First Name', 'Last Name', 'Address', 'Gender'):
+                people[field][i] = source[field][k]
+            people['Age'][i] = max(source['Age'][k] + int(rng.integers(-2, 3)), 0)
+            # a typo in one or two of the name and address fields
+            for field in rng.choice(TYPO_COLUMNS, int(rng.integers(1, 3)), replace=False):
+                people[field][i] = typo(rng, people[field][i])
+            duplicates.append([start + i, source['Identifier'][k] - 1])
+        for field in PERSON_COLUMNS:
+            df[field] = people[field]
+            self.history[field] = (self.history[field] + people[field])[-HISTORY:]
+
+        # labels go by the final values, gender duplicates included
+        cells = pd.concat([column.labels(df[column.field], start) for column in self.columns] or
+                          [pd.DataFrame(columns=LABEL_COLUMNS)], ignore_index=True)
+        cells = cells.sort_values('Row', kind='stable', ignore_index=True)
+
+        self.rows += rows
+        return df, cells, pd.DataFrame(duplicates, columns=DUPLICATE_COLUMNS)
+
+    def batches(self, rows, batch_size=100000):
+        while rows > 0:
+            yield self.batch(min(rows, batch_size))
+            rows -= batch_size
+
+
+def output_paths(path):
+    """Returns where the cell labels and duplicates for data written to path go"""
+    stem = os.path.splitext(path)[0]
+    return stem + '.labels.csv', stem + '.duplicates.csv'
+
+
+def write(path, rules, rows, seed=0, batch_size=100000, **rates):
+    """Writes rows of synthetic data to path, as csv, xlsx or parquet by its extension, plus its labels.
+
+    rates are Generator's autocorrect_rate, unknown_rate, duplicate_rate and null_rate.
+    Returns the paths of the data, its cell labels and its duplicates.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    writer = {'.csv': CsvWriter, '.xlsx': XlsxWriter, '.parquet': ParquetWriter}[extension](path)
+    labels_path, duplicates_path = output_paths(path)
+
+    generator = Generator(rules, seed, **rates)
+    try:
+        for i, (df, cells, duplicates) in enumerate(generator.batches(rows, batch_size)):
+            writer.write(df)
+            cells.to_csv(labels_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            duplicates.to_csv(duplicates_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    finally:
+        writer.close()
+    return path, labels_path, duplicates_path
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.path = path
+        self.started = False
+
+    def write(self, df):
+        df.to_csv(self.path, mode='a' if self.started else 'w', header=not self.started, index=False)
+        self.started = True
+
+    def close(self):
+        pass
+
+
+class XlsxWriter:
+    # Excel's row limit, less the header
+    MAX_ROWS = 1048575
+
+    def __init__(self, path):
+        import xlsxwriter
+
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self.worksheet = self.workbook.add_worksheet()
+        self.row = 0
+
+    def write(self, df):
+        if self.row == 0:
+            self.worksheet.write_row(0, 0, df.columns.tolist())
+            self.row = 1
+        if self.row + len(df) > self.MAX_ROWS + 1:
+            raise ValueError("xlsx holds at most {} rows".format(self.MAX_ROWS))
+        for values in df.itertuples(index=False, name=None):
+            # xlsxwriter can't write NaN, a missing number is left as an empty cell like a missing string
+            self.worksheet.write_row(self.row, 0, [None if pd.isna(value) else value for value in values])
+            self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from local_modules.autocorrect import autocorrect
+
+    arg_parser = argparse.ArgumentParser(description='Generate synthetic spreadsheet data with ground-truth labels')
+    arg_parser.add_argument('-r', '--rules', required=True, help='the rules file to draw column values from')
+    arg_parser.add_argument('-n', '--rows', type=int, required=True, help='rows to generate')
+    arg_parser.add_argument('-o', '--output', required=True, help='file to write: .csv, .xlsx or .parquet')
+    arg_parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    arg_parser.add_argument('--autocorrect-rate', type=float, default=AUTOCORRECT_RATE,
+                            help='share of rule cells autocorrect should fix (default: {})'.format(AUTOCORRECT_RATE))
+    arg_parser.add_argument('--unknown-rate', type=float, default=UNKNOWN_RATE,
+                            help='share of rule cells that should be flagged (default: {})'.format(UNKNOWN_RATE))
+    arg_parser.add_argument('--duplicate-rate', type=float, default=DUPLICATE_RATE,
+                            help='share of records duplicating an earlier one (default: {})'.format(DUPLICATE_RATE))
+    arg_parser.add_argument('--null-rate', type=float, default=NULL_RATE,
+                            help='share of rule cells left empty (default: {})'.format(NULL_RATE))
+    args = arg_parser.parse_args()
+
+    paths = write(args.output, autocorrect.fields(args.rules), args.rows, args.seed,
+                  autocorrect_rate=args.autocorrect_rate, unknown_rate=args.unknown_rate,
+                  duplicate_rate=args.duplicate_rate, null_rate=args.null_rate)
+    print("\n".join(paths))
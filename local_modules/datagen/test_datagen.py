@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from local_modules.datagen import datagen
+from local_modules.spreadcheck import spreadcheck
+
+
+rules = {'Gender': {'allowed_value_set': {'M', 'F', 'Unknown', 'Other'},
+                    'autocorrect_dict': {'male': 'M', 'Female': 'F', 'unk': 'Unknown'}},
+         'Zip': {'allowed_value_set': {19001, 19002},
+                 'autocorrect_dict': {}}}
+
+
+def test_same_seed_same_data():
+    first = [frame for batch in datagen.Generator(rules, seed=3).batches(500, 200) for frame in batch]
+    second = [frame for batch in datagen.Generator(rules, seed=3).batches(500, 200) for frame in batch]
+    for a, b in zip(first, second):
+        pd.testing.assert_frame_equal(a, b)
+
+
+def test_labels_match_what_clean_does(tmp_path):
+    data_file, labels_file, _ = datagen.write(str(tmp_path / "data.csv"), rules, 2000, seed=1, batch_size=700,
+                                              autocorrect_rate=0.1, unknown_rate=0.05)
+    labels = pd.read_csv(labels_file)
+    results = spreadcheck.clean(data_file, rules, str(tmp_path / "temp"))
+    assert results.corrections == (labels['Label'] == datagen.CORRECTED).sum() > 0
+    assert results.flags == (labels['Label'] == datagen.FLAGGED).sum() > 0
+
+    flagged = labels[labels['Label'] == datagen.FLAGGED]
+    for field in rules:
+        expected = flagged.loc[flagged['Column'] == field, 'Row'].tolist()
+        assert results.invalid['Sheet1'][field].tolist() == expected
+
+
+def test_duplicates_are_typos_of_earlier_records(tmp_path):
+    data_file, _, duplicates_file = datagen.write(str(tmp_path / "data.parquet"), rules, 1000, seed=2,
+                                                  batch_size=300, duplicate_rate=0.1)
+    df = pq.read_table(data_file).to_pandas()
+    duplicates = pd.read_csv(duplicates_file)
+    assert len(df) == 1000
+    assert 50 < len(duplicates) < 150
+    assert (duplicates['Duplicate Of'] < duplicates['Row']).all()
+    for row, original in duplicates.values:
+        changed = [field for field in datagen.TYPO_COLUMNS if df.loc[row, field] != df.loc[original, field]]
+        assert 1 <= len(changed) <= 2
+        assert abs(df.loc[row, 'Age'] - df.loc[original, 'Age']) <= 2
+
+
+def test_typos_always_change_the_text():
+    rng = np.random.default_rng(0)
+    for text in ["aa", "Allen", "Hall St", "a", "zz top"] * 200:
+        assert datagen.typo(rng, text) != text
+
+
+def test_xlsx_writer_leaves_missing_values_empty(tmp_path):
+    path = str(tmp_path / "data.xlsx")
+    writer = datagen.XlsxWriter(path)
+    writer.write(pd.DataFrame({'Age': [30.0, np.nan], 'Gender': [None, "F"]}))
+    writer.close()
+    assert pd.read_excel(path).isna().values.tolist() == [[False, True], [True, False]]
@@ -0,0 +1,109 @@
+import glob
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from local_modules.spreadcheck import spreadcheck
+
+# Cleans many spreadsheets against one set of rules without the GUI, a process per file.
+
+REVIEW_SUFFIX = '_review.xlsx'
+SUMMARY_COLUMNS = ['File', 'Corrections', 'Flags', 'Result']
+
+
+def find_inputs(patterns):
+    """Expands directories (their files, not subdirectories) and glob patterns into a sorted list of input files"""
+    inputs = set()
+    for pattern in patterns:
+        paths = glob.glob(os.path.join(pattern, '*')) if os.path.isdir(pattern) else glob.glob(pattern)
+        # skip Excel's lock files and anything left over from earlier runs
+        inputs.update(path for path in paths if os.path.isfile(path) and not os.path.basename(path).startswith(('~$', '.')))
+    return sorted(inputs)
+
+
+def output_stems(spreadsheets):
+    """Names the outputs of each spreadsheet after it, without its extension unless another input has the same
+    name otherwise (data.csv and data.xlsx give data.csv.csv and data.xlsx.csv rather than overwriting data.csv).
+
+    Raises ValueError for inputs with the same file name in different directories.
+    """
+    names = [os.path.basename(spreadsheet) for spreadsheet in spreadsheets]
+    repeated = sorted({name for name in names if names.count(name) > 1})
+    if repeated:
+        raise ValueError("Inputs with the same name would overwrite each other's outputs: " + ", ".join(repeated))
+    stems = [os.path.splitext(name)[0] for name in names]
+    return [stem if stems.count(stem) == 1 else name for stem, name in zip(stems, names)]
+
+
+def output_paths(spreadsheet, target_dir, extension='.csv', stem=None):
+    """Returns where the cleaned data and review workbook for spreadsheet go, named after stem if given"""
+    stem = stem or os.path.splitext(os.path.basename(spreadsheet))[0]
+    return os.path.join(target_dir, stem + extension), os.path.join(target_dir, stem + REVIEW_SUFFIX)
+
+
+def clean_file(spreadsheet, rules, target_dir, options=None, stem=None):
+    """Cleans one spreadsheet, writing its cleaned data and review workbook to target_dir.
+
+    options are passed on to spreadcheck.clean, apart from tempfolder, extension ('.csv' or '.parquet', the
+    format to save the cleaned data in) and profile (True to save a cProfile of the run to target_dir).
+    The outputs are named after stem, see output_stems, or the spreadsheet's name without its extension.
+    Returns the SpreadCheck results, with spreadsheet pointing at the review workbook in target_dir. Anything
+    going wrong comes back as a failed SpreadCheck, rather than stopping the rest of the batch.
+    """
+    options = options or {}
+    output, review = output_paths(spreadsheet, target_dir, options.get('extension') or '.csv', stem)
+
+    # every file gets its own temp folder, so files cleaned at the same time don't trip over each other
+    tempfolder = tempfile.mkdtemp(prefix='spreadcheck-', dir=options.get('tempfolder'))
+    try:
+        clean_options = {key: value for key, value in options.items() if key not in ('tempfolder', 'extension', 'profile')}
+        if options.get('profile'):
+            clean_options['profile'] = os.path.splitext(output)[0] + '.prof'
+        results = spreadcheck.clean(spreadsheet, rules, tempfolder, **clean_options)
+        if results.errors:
+            return results
+        spreadcheck.save_cleaned(results, output)
+        shutil.move(results.spreadsheet, review)
+        results.spreadsheet = review
+        # the cleaned data has been saved and goes with the temp folder, no need to ship its flags back either
+        results.cleaned_files = {}
+        results.invalid = {}
+        return results
+    except Exception as err:
+        return spreadcheck.fail(spreadcheck.SpreadCheck(spreadsheet), "ERROR: " + str(err))
+    finally:
+        shutil.rmtree(tempfolder, ignore_errors=True)
+
+
+def clean_batch(spreadsheets, rules, target_dir, workers=None, options=None):
+    """Cleans every spreadsheet against rules, with up to workers files at a time.
+
+    Returns a list of (spreadsheet, SpreadCheck results) in the order given. Raises ValueError, before cleaning
+    anything, if two spreadsheets' outputs would have the same name.
+    """
+    stems = output_stems(spreadsheets)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    count = len(spreadsheets)
+
+    if workers and workers > 1 and count > 1:
+        with ProcessPoolExecutor(min(workers, count), mp_context=spreadcheck.pool_context()) as pool:
+            results = list(pool.map(clean_file, spreadsheets, [rules] * count, [target_dir] * count, [options] * count,
+                                    stems))
+    else:
+        results = [clean_file(spreadsheet, rules, target_dir, options, stem)
+                   for spreadsheet, stem in zip(spreadsheets, stems)]
+    return list(zip(spreadsheets, results))
+
+
+def summary_rows(batch):
+    """Rows of SUMMARY_COLUMNS for the results of clean_batch, plus a total row"""
+    rows = []
+    for spreadsheet, results in batch:
+        outcome = '; '.join(results.errors) if results.errors else 'OK'
+        rows.append([os.path.basename(spreadsheet), results.corrections, results.flags, outcome])
+    failed = sum(1 for _, results in batch if results.errors)
+    rows.append(['Total ({} files, {} failed)'.format(len(batch), failed),
+                 sum(row[1] for row in rows), sum(row[2] for row in rows), ''])
+    return rows
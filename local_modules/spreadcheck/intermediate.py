@@ -0,0 +1,126 @@
+import glob
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+
+# Cleaned data is kept between validating and saving as Arrow IPC files in the temp folder. Reading it back
+# memory-maps the files, so saving to csv or parquet and writing the review workbook parse nothing, and a
+# parquet export goes straight from the mapped buffers.
+#
+# Each tab's data is a folder of segment files, a new segment started whenever a chunk's column types differ
+# from those of the segment being written (e.g. a column that is all empty in one chunk of a csv).
+
+# how missing values are shown in the review workbook and csv output, and what rules call them
+NULL = "NULL"
+
+
+def to_arrow(df):
+    """Converts a DataFrame to an Arrow table, with NULL (e.g. from an autocorrection or an edit) as missing"""
+    arrays = []
+    for name in df.columns:
+        column = df[name]
+        if column.dtype == object or isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.mask(column == NULL)
+        try:
+            array = pa.array(column, from_pandas=True)
+            # categorical rule columns are stored as plain values, so their type doesn't hang on the categories
+            if pa.types.is_dictionary(array.type):
+                array = array.dictionary_decode()
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # numbers and text in one column are kept as text
+            column = column.astype(object)
+            array = pa.array(column.where(column.isna(), column.astype(str)), from_pandas=True)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[str(name) for name in df.columns])
+
+
+class IntermediateWriter:
+    """Appends DataFrames to the Arrow segments in folder, replacing whatever was there"""
+    def __init__(self, folder):
+        self.folder = folder
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        self.writer = None
+        self.schema = None
+        self.segments = 0
+
+    def write(self, df):
+        table = to_arrow(df)
+        if self.writer is None or not table.schema.equals(self.schema):
+            self.close()
+            self.schema = table.schema
+            path = os.path.join(self.folder, 'part-{:05d}.arrow'.format(self.segments))
+            self.writer = pa.ipc.new_file(path, self.schema)
+            self.segments += 1
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def segments(folder):
+    return sorted(glob.glob(os.path.join(folder, 'part-*.arrow')))
+
+
+def read_tables(folder):
+    """Yields each segment in folder as a memory-mapped Arrow table"""
+    for path in segments(folder):
+        with pa.memory_map(path) as source:
+            yield pa.ipc.open_file(source).read_all()
+
+
+def read_batches(folder, rows=None, fill=True):
+    """Yields the data in folder as DataFrames of up to rows rows (a segment at a time by default), indexed by
+    their position in the whole data. With fill, missing values are filled with NULL, for writing them out as is.
+    """
+    start = 0
+    for table in read_tables(folder):
+        # an empty segment still yields its columns
+        for offset in range(0, max(table.num_rows, 1), rows or max(table.num_rows, 1)):
+            df = table.slice(offset, rows).to_pandas()
+            df.index = pd.RangeIndex(start, start + len(df))
+            if fill:
+                df.fillna(NULL, inplace= True)
+            start += len(df)
+            yield df
+
+
+def read_frame(folder):
+    return pd.concat(list(read_batches(folder)))
+
+
+def unified_schema(schemas):
+    """One schema the given segment schemas can all be cast to: numbers widen to float, other mixes to text"""
+    fields = []
+    for name in schemas[0].names:
+        types = {schema.field(name).type for schema in schemas} - {pa.null()}
+        if len(types) > 1:
+            numeric = all(pa.types.is_integer(kind) or pa.types.is_floating(kind) for kind in types)
+            types = {pa.float64() if numeric else pa.string()}
+        fields.append(pa.field(name, types.pop() if types else pa.null()))
+    return pa.schema(fields)
+
+
+def write_parquet(folder, destination):
+    """Writes the data in folder to a parquet file straight from the mapped Arrow segments"""
+    import pyarrow.parquet as pq
+
+    tables = list(read_tables(folder))
+    schema = unified_schema([table.schema for table in tables])
+    writer = pq.ParquetWriter(destination, schema)
+    try:
+        for table in tables:
+            writer.write_table(table.cast(schema))
+    finally:
+        writer.close()
+
+
+def write_frame_parquet(df, destination):
+    """Writes a DataFrame to a parquet file, with NULL as missing"""
+    import pyarrow.parquet as pq
+
+    pq.write_table(to_arrow(df), destination)
@@ -0,0 +1,288 @@
+import os
+import pandas as pd
+import pyarrow as pa
+
+# Spreadsheet loaders, picked by sniffing the file's leading bytes and then its extension,
+# so each file is parsed once by the reader that fits it.
+#
+# Loaders return a DataFrame or, where the format can be read straight into Arrow, an Arrow table. load then
+# makes a DataFrame of it with the columns asked for as categorical dictionary-encoded, and the text of Arrow
+# tables left in its Arrow buffers: only the distinct values of those columns become Python objects.
+
+# leading bytes -> format
+MAGIC = [
+    (b'PK\x03\x04', 'xlsx'),                            # zip container (xlsx, xlsm)
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'xls'),       # OLE2 compound document
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'feather'),                             # arrow IPC file, aka feather v2
+    (b'FEA1', 'feather'),                               # feather v1
+    (b'\xff\xff\xff\xff', 'arrow'),                     # arrow IPC stream
+]
+
+# extension -> format, for files without a recognizable signature (plain text)
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.txt': 'csv',
+    '.tsv': 'tsv',
+    '.tab': 'tsv',
+}
+
+# format -> function(path, columns=None) returning a DataFrame or an Arrow table.
+# Formats that can hold several sheets also take a sheet name (or position) argument.
+LOADERS = {}
+
+# formats that can hold several sheets
+MULTI_SHEET = {'xlsx', 'xls'}
+
+# Arrow text columns as pandas strings backed by the same Arrow buffers
+ARROW_TEXT = {pa.string(): pd.StringDtype('pyarrow')}
+
+# format -> function(path, chunksize, columns=None) yielding DataFrames or Arrow tables of up to chunksize rows.
+# Multi-sheet formats also take a sheet name (or position) argument, as with LOADERS.
+CHUNK_LOADERS = {}
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def loader(fmt, chunked=False):
+    def register(read):
+        (CHUNK_LOADERS if chunked else LOADERS)[fmt] = read
+        return read
+    return register
+
+
+def sniff(path):
+    """Returns the format name of the spreadsheet at path"""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for magic, fmt in MAGIC:
+        if head.startswith(magic):
+            return fmt
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    # anything else had better be text
+    if b'\x00' in head:
+        raise UnsupportedFormat(path)
+    return 'csv'
+
+
+def to_frame(data, categorical=None):
+    """Makes a DataFrame of a loader's DataFrame or Arrow table, with the categorical columns as Categoricals"""
+    if isinstance(data, pd.DataFrame):
+        for name in categorical or ():
+            if name in data.columns:
+                data[name] = data[name].astype('category')
+        return data
+
+    for name in categorical or ():
+        if name not in data.column_names:
+            continue
+        i = data.schema.get_field_index(name)
+        kind = data.schema.field(i).type
+        # an all empty column has nothing to encode
+        if not pa.types.is_null(kind) and not pa.types.is_dictionary(kind):
+            data = data.set_column(i, name, data.column(i).dictionary_encode())
+    return data.to_pandas(types_mapper=ARROW_TEXT.get)
+
+
+def load(path, columns=None, fmt=None, sheet=None, categorical=None):
+    """Reads the spreadsheet at path (the given sheet, or the first one), optionally just the given columns.
+
+    The categorical columns (e.g. the ones rules check) are read as Categoricals.
+    """
+    fmt = fmt or sniff(path)
+    if fmt not in LOADERS:
+        raise UnsupportedFormat(path)
+    if sheet is not None and fmt in MULTI_SHEET:
+        return to_frame(LOADERS[fmt](path, columns, sheet), categorical)
+    return to_frame(LOADERS[fmt](path, columns), categorical)
+
+
+def sheet_names(path, fmt=None):
+    """Returns the names of the sheets in the spreadsheet at path, [None] for single table formats"""
+    fmt = fmt or sniff(path)
+    if fmt not in MULTI_SHEET:
+        return [None]
+    with pd.ExcelFile(path) as xl:
+        return xl.sheet_names
+
+
+def load_chunks(path, chunksize, columns=None, fmt=None, categorical=None, sheet=None):
+    """Reads the spreadsheet at path (the given sheet, or the first one) in chunks of up to chunksize rows, for
+    formats that can be streamed
+    """
+    fmt = fmt or sniff(path)
+    if fmt not in CHUNK_LOADERS:
+        raise UnsupportedFormat(path)
+    if sheet is not None and fmt in MULTI_SHEET:
+        chunks = CHUNK_LOADERS[fmt](path, chunksize, columns, sheet)
+    else:
+        chunks = CHUNK_LOADERS[fmt](path, chunksize, columns)
+    return (to_frame(chunk, categorical) for chunk in chunks)
+
+
+def can_stream(path):
+    return sniff(path) in CHUNK_LOADERS
+
+
+def read_text(path, delimiter, columns=None):
+    """Reads a delimited text file into an Arrow table, typed the way pandas would have.
+
+    Arrow reads dates and times as such where pandas kept the text, so those columns are read as text, to come
+    out as they went in. Files Arrow can't read, or whose header pandas would have to fix up (blank or repeated
+    column names), are left to pandas.
+    """
+    import pyarrow.csv as csv
+
+    parse_options = csv.ParseOptions(delimiter=delimiter)
+    try:
+        # the column types Arrow makes of the first block
+        with csv.open_csv(path, parse_options=parse_options) as reader:
+            schema = reader.schema
+        if '' in schema.names or len(set(schema.names)) < len(schema.names):
+            return None
+        text = {field.name: pa.string() for field in schema if pa.types.is_temporal(field.type)}
+        table = csv.read_csv(path, parse_options=parse_options,
+                             convert_options=csv.ConvertOptions(column_types=text, strings_can_be_null=True,
+                                                                include_columns=columns))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+    for i, field in enumerate(table.schema):
+        # dates first showing up after the first block
+        if pa.types.is_temporal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+        # empty columns are numbers to pandas
+        elif pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table
+
+
+@loader('csv')
+def read_csv(path, columns=None):
+    table = read_text(path, ',', columns)
+    return pd.read_csv(path, usecols=columns) if table is None else table
+
+
+@loader('tsv')
+def read_tsv(path, columns=None):
+    table = read_text(path, '\t', columns)
+    return pd.read_csv(path, sep='\t', usecols=columns) if table is None else table
+
+
+@loader('xlsx')
+@loader('xls')
+def read_excel(path, columns=None, sheet=0):
+    return pd.read_excel(path, sheet_name=sheet, usecols=columns)
+
+
+@loader('parquet')
+def read_parquet(path, columns=None):
+    import pyarrow.parquet as pq
+
+    return pq.read_table(path, columns=columns)
+
+
+@loader('feather')
+def read_feather(path, columns=None):
+    import pyarrow.feather as feather
+
+    return feather.read_table(path, columns=columns)
+
+
+@loader('arrow')
+def read_arrow_stream(path, columns=None):
+    with pa.OSFile(path, 'rb') as source:
+        table = pa.ipc.open_stream(source).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+@loader('csv', chunked=True)
+def read_csv_chunks(path, chunksize, columns=None):
+    return pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+
+@loader('tsv', chunked=True)
+def read_tsv_chunks(path, chunksize, columns=None):
+    return pd.read_csv(path, sep='\t', usecols=columns, chunksize=chunksize)
+
+
+@loader('xlsx', chunked=True)
+def read_excel_chunks(path, chunksize, columns=None, sheet=0):
+    """Streams the rows of a sheet from its XML, chunksize at a time, read-only and without styles.
+
+    Cells are converted and each chunk parsed the way read_excel does it, so the chunks hold read_excel's values,
+    only a piece at a time. Their types are a chunk's view, though: a number column read_excel makes float (for a
+    gap or a fraction somewhere) is int in the chunks before the first float turns up, and float from then on, even
+    in chunks of whole numbers. The header is the first row that isn't blank.
+    """
+    import openpyxl
+    from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+    from pandas.io.parsers import TextParser
+
+    def value(cell):
+        if cell.value is None:
+            return ""
+        if cell.data_type == TYPE_ERROR:
+            return float('nan')
+        if cell.data_type == TYPE_NUMERIC and int(cell.value) == cell.value:
+            return int(cell.value)
+        return cell.value
+
+    # columns that have been float in a chunk so far
+    floats = set()
+
+    def parse(rows):
+        # a header row above each chunk, so every chunk gets the same column names
+        # and blank rows kept, a one column sheet's blank row otherwise being taken for an empty line
+        df = TextParser([header] + rows, header=0, usecols=columns, skip_blank_lines=False).read()
+        promote = [column for column in df.columns if column in floats and pd.api.types.is_integer_dtype(df[column])]
+        df[promote] = df[promote].astype(float)
+        floats.update(column for column in df.columns if pd.api.types.is_float_dtype(df[column]))
+        return df
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        worksheet = workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+        # some writers record the wrong size, read_only trusts it
+        worksheet.reset_dimensions()
+        header = None
+        rows = []
+        # blank rows count once there's something after them, read_excel drops the trailing ones
+        blank = 0
+        yielded = False
+        for cells in worksheet.iter_rows():
+            row = [value(cell) for cell in cells]
+            while row and row[-1] == "":
+                row.pop()
+            if header is None:
+                header = row or None
+                continue
+            if not row:
+                blank += 1
+                continue
+            for row in [[""] * len(header)] * blank + [row]:
+                rows.append(row + [""] * (len(header) - len(row)))
+                if len(rows) == chunksize:
+                    yield parse(rows)
+                    rows = []
+                    yielded = True
+            blank = 0
+        # an empty sheet still has its columns, if any
+        if rows or not yielded:
+            yield parse(rows) if header is not None else pd.DataFrame()
+    finally:
+        workbook.close()
+
+
+@loader('parquet', chunked=True)
+def read_parquet_chunks(path, chunksize, columns=None):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+        yield pa.Table.from_batches([batch])
@@ -0,0 +1,26 @@
+from collections import namedtuple
+
+# What spreadcheck reports while it runs. Kept apart from spreadcheck, which pulls in pandas and the rest of the
+# data stack, so the gui can handle progress without waiting for all of that to load.
+
+# stages reported to progress callbacks
+LOADING = 'Loading'
+CHECKING = 'Checking'
+WRITING = 'Writing review'
+
+# rows: rows checked or written so far; total: rows in all, None until known; flags: flags found so far
+Progress = namedtuple('Progress', ['stage', 'rows', 'total', 'flags'])
+
+CANCELLED = "Validation cancelled"
+
+
+class Cancelled(Exception):
+    pass
+
+
+def report(progress, cancel, stage, rows=0, total=None, flags=0):
+    """Sends a Progress to the progress callback, first raising Cancelled if cancel has been set"""
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+    if progress:
+        progress(Progress(stage, rows, total, flags))
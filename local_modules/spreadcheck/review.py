@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+from xlsxwriter.utility import xl_rowcol_to_cell
+
+# review workbook column recording where a flagged row sits in the input spreadsheet
+ORIGINAL_ROW = 'Original Row'
+
+FLAGS_SHEET = 'Flags'
+FLAGS_COLUMNS = ['Row', 'Column', 'Value', 'Message']
+
+# Excel ignores hyperlinks past this many per worksheet
+MAX_HYPERLINKS = 65530
+
+# most flagged cells that get a comment by default. Comments are what makes a review with many flags slow to write
+# and to open, so past this flagged cells just keep their highlight and their row on the Flags sheet
+COMMENT_LIMIT = 1000
+
+
+class ReviewWriter:
+    """Writes the review workbook for a spreadsheet one chunk of checked rows at a time, one tab per sheet.
+
+    Every row is written once, in order, so xlsxwriter can run in constant_memory mode and stream
+    the workbook to disk (under tempfolder) instead of holding it in memory.
+
+    sheet_names:    review tabs, one for each checked sheet of the input
+    flagged_only:   write only the flagged rows, with a leading ORIGINAL_ROW column, instead of hiding clean rows
+    flags_sheet:    list every flag on a separate Flags sheet, linked back to its cell
+    comment_limit:  most flagged cells to also annotate with a comment, None for all of them. The flags past it
+                    are listed on the Flags sheet, which is added for them if flags_sheet is off
+    """
+    def __init__(self, filepath, sheet_names=('Sheet1',), tempfolder=None, flagged_only=False, flags_sheet=False,
+                 comment_limit=COMMENT_LIMIT):
+        self.flagged_only = flagged_only
+        self.comment_limit = comment_limit
+        self.comments = 0
+
+        self.workbook = xlsxwriter.Workbook(filepath, {
+            'constant_memory': True,
+            'tmpdir': tempfolder,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss'
+            })
+
+        ### WORKBOOK FORMATS ###
+        self.highlight = self.workbook.add_format({'bg_color': '#FFEB9C' })
+        self.header = self.workbook.add_format({
+            'bold': True,
+            'text_wrap': True,
+            'valign': 'top',
+            'fg_color': '#D7E4BC',
+            'border': 1
+            })
+
+        # tabs are laid out up front, so they keep the input's order whichever sheet is written first
+        self.sheets = {name: self.workbook.add_worksheet(name) for name in sheet_names}
+
+        self.flags = None
+        if flags_sheet:
+            self.add_flags_sheet()
+
+    def add_flags_sheet(self):
+        # with several tabs, flags lead with the tab they're on
+        flags_columns = ['Sheet'] + FLAGS_COLUMNS if len(self.sheets) > 1 else FLAGS_COLUMNS
+        self.flags_offset = len(flags_columns) - len(FLAGS_COLUMNS)
+        self.flags = self.workbook.add_worksheet(FLAGS_SHEET if FLAGS_SHEET not in self.sheets else FLAGS_SHEET + ' (review)')
+        self.write_columns(self.flags, flags_columns)
+        self.flags.set_column(len(flags_columns) - 1, len(flags_columns) - 1, 80)
+        self.flag_row = 1
+
+    def write_columns(self, worksheet, columns):
+        # Set column widths
+        worksheet.set_column(0, len(columns)-1, 22)
+
+        # Write the column headers with the defined format.
+        for col_num, value in enumerate(columns):
+            worksheet.write(0, col_num, value, self.header)
+
+    def start_sheet(self, name, columns, messages):
+        """Moves on to the named tab, writing its header. messages: rule column -> comment for its flagged cells"""
+        self.worksheet = self.sheets[name]
+        self.messages = messages
+        self.row = 1
+        self.rows_read = 0
+
+        columns = list(columns)
+        self.worksheet.set_default_row(hide_unused_rows=True)
+        self.write_columns(self.worksheet, [ORIGINAL_ROW] + columns if self.flagged_only else columns)
+
+    def write(self, df, invalid):
+        """Writes the next chunk of rows, highlighting and annotating the cells flagged in invalid.
+
+        Rows without flags are hidden, or with flagged_only left out altogether.
+        """
+        flag_rows = np.zeros(len(df), dtype=bool)
+        for mask in invalid.values():
+            flag_rows |= mask
+        offset = 1 if self.flagged_only else 0
+        flag_columns = [(df.columns.get_loc(field), field, mask) for field, mask in invalid.items()]
+
+        if self.flagged_only:
+            positions = np.flatnonzero(flag_rows)
+            rows = df.take(positions)
+        else:
+            positions = range(len(df))
+            rows = df
+
+        for i, values in zip(positions, rows.itertuples(index=False, name=None)):
+            if self.flagged_only:
+                # +2 for header and 1-index offset
+                self.worksheet.write(self.row, 0, self.rows_read + i + 2)
+            elif not flag_rows[i]:
+                self.worksheet.set_row(self.row, None, None, {'hidden': True})
+            self.worksheet.write_row(self.row, offset, values)
+            if flag_rows[i]:
+                for column, field, mask in flag_columns:
+                    if mask[i]:
+                        self.flag(self.row, column + offset, field, values[column], self.rows_read + i + 2)
+            self.row += 1
+
+        self.rows_read += len(df)
+
+    def flag(self, row, column, field, value, original_row):
+        # the shared highlight format is set on the cell itself, rather than a conditional format per cell
+        self.worksheet.write(row, column, value, self.highlight)
+
+        if self.comment_limit is None or self.comments < self.comment_limit:
+            self.worksheet.write_comment(row, column, self.messages[field])
+            self.comments += 1
+        elif self.flags is None:
+            # past the comment limit, the message goes on the Flags sheet instead
+            self.add_flags_sheet()
+
+        if self.flags is not None:
+            if self.flags_offset:
+                self.flags.write(self.flag_row, 0, self.worksheet.name)
+            if self.flag_row <= MAX_HYPERLINKS:
+                cell = xl_rowcol_to_cell(row, column)
+                link = "internal:'{}'!{}".format(self.worksheet.name, cell)
+                self.flags.write_url(self.flag_row, self.flags_offset, link, string=str(original_row))
+            else:
+                self.flags.write(self.flag_row, self.flags_offset, original_row)
+            self.flags.write_row(self.flag_row, self.flags_offset + 1, [field, value, self.messages[field]])
+            self.flag_row += 1
+
+    def close(self):
+        self.workbook.close()
+
+    def abort(self):
+        """Closes the workbook and deletes it, for runs stopped part way"""
+        self.workbook.close()
+        if os.path.exists(self.workbook.filename):
+            os.remove(self.workbook.filename)
+
+
+def read_edits(filepath, sheet_name='Sheet1'):
+    """Reads a tab of a flagged rows only review workbook back, indexed by each row's position in the cleaned data"""
+    edits = pd.read_excel(filepath, sheet_name=sheet_name, index_col=0)
+    edits.index = edits.index - 2
+    return edits
@@ -1,7 +1,13 @@
+import numpy as np
 import pandas as pd
-from pandas_schema import Column, Schema
-from pandas_schema.validation import InListValidation
-import xlsxwriter, os
+import cProfile, multiprocessing, os, sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from local_modules.spreadcheck import intermediate, loaders
+from local_modules.spreadcheck.intermediate import NULL
+from local_modules.spreadcheck.progress import LOADING, CHECKING, WRITING, Progress, CANCELLED, Cancelled, report
+from local_modules.spreadcheck.review import COMMENT_LIMIT, ReviewWriter, read_edits
+from local_modules.spreadcheck.timing import Timings
 
 # return object
 class SpreadCheck:
@@ -11,140 +17,594 @@ class SpreadCheck:
         self.messages = []
         self.corrections = 0;
         self.flags = 0;
+        self.rows = 0
+        # corrections and flags for each tab of the review workbook, one per checked input sheet
+        self.sheets = {}
+        # for each tab, the folder holding its cleaned data (after autocorrection) as Arrow, see intermediate
+        self.cleaned_files = {}
+        # for each tab, rule column -> sorted row positions of its flagged cells, and rule column -> message for them.
+        # Positions rather than a mask per column, so a long file with few flags doesn't take a mask's memory
+        self.invalid = {}
+        self.flag_messages = {}
+        # ReviewWriter settings, for writing the review workbook later
+        self.review_options = {}
+        # modification time of the written spreadsheet, to tell whether it was edited afterwards.
+        # None until the review workbook is written
+        self.written_at = None
+        # whether the spreadsheet holds only the flagged rows
+        self.flagged_only = False
+        # time, rows/sec and peak memory of each stage of the run
+        self.timings = Timings()
 
-        
-def clean(spreadsheet, rules, tempfolder, progress=None):
+    # the cleaned data of single sheet spreadsheets
+    @property
+    def dataframe(self):
+        return intermediate.read_frame(self.cleaned_file) if len(self.cleaned_files) == 1 else None
 
-    if not os.path.exists(tempfolder):
-            os.makedirs(tempfolder)
-    filepath = tempfolder +'/temporary_file.xlsx'
+    @property
+    def cleaned_file(self):
+        return next(iter(self.cleaned_files.values())) if len(self.cleaned_files) == 1 else None
 
-    results = SpreadCheck(filepath)
 
-    ################################
-    #   LOAD SPREADSHEET TO DF     #
-    ################################
-    try:
-        df = pd.read_csv(spreadsheet)
-    except:
-        try:
-            df = pd.read_excel(spreadsheet)
-        except:
-            results.spreadsheet = None
-            results.errors.append("ERROR: Unaccepted File Format")
-            return results
+def invalid_mask(series, allowed_value_set):
+    """Returns a boolean array marking the cells of series that are not in allowed_value_set.
 
+    Each distinct value is checked once and the result is broadcast back over the column. Missing values
+    count as NULL, so they pass where the rules allow NULL.
+    """
+    codes, uniques = pd.factorize(series)
+    valid = np.fromiter((value in allowed_value_set for value in uniques), dtype=bool, count=len(uniques))
+    # factorize codes missing values as -1, which picks up the trailing entry
+    valid = np.append(valid, NULL in allowed_value_set)
+    return ~valid[codes]
+
+
+def flagged_positions(invalid, offset=0):
+    """Turns rule column -> boolean mask into rule column -> positions of the flagged cells, counted from offset"""
+    return {field: np.flatnonzero(mask) + offset for field, mask in invalid.items()}
+
+
+def chunk_masks(positions, start, length):
+    """The boolean masks of the rows start to start + length, from rule column -> flagged positions"""
+    masks = {}
+    for field, flagged in positions.items():
+        mask = np.zeros(length, dtype=bool)
+        mask[flagged[np.searchsorted(flagged, start):np.searchsorted(flagged, start + length)] - start] = True
+        masks[field] = mask
+    return masks
+
+
+def validate(df, rules):
+    """Returns a dict of rule column -> boolean mask of cells failing that column's allowed values"""
+    return {field: invalid_mask(df[field], rule['allowed_value_set']) for field, rule in rules.items()}
 
-    ################################
-    #   SCHEMAS VALIDATION         #
-    ################################
-    schemas_list = []
 
-    df.fillna("NULL", inplace= True)
+def autocorrect_mask(series, rule):
+    """Returns (corrected series, boolean array marking the corrected cells) for one rule column.
 
+    Only values outside the allowed set that have an autocorrect mapping are replaced,
+    and each distinct value is looked up once. Missing values are looked up as NULL.
+    """
+    allowed_value_set = rule['allowed_value_set']
+    autocorrect_dict = rule['autocorrect_dict']
+    codes, uniques = pd.factorize(series)
+    # factorize codes missing values as -1, which picks up the trailing NULL
+    values = np.array(list(uniques) + [NULL], dtype=object)
+    correctable = np.fromiter((value not in allowed_value_set and value in autocorrect_dict for value in values),
+                              dtype=bool, count=len(values))
+    mask = correctable[codes]
+    if not mask.any():
+        return series, mask
+    corrected_values = np.array([autocorrect_dict.get(value, value) for value in values], dtype=object)
+    series = add_categories(series, corrected_values[correctable])
+    # cells left alone take nothing, as categoricals won't take values outside their categories, even unused
+    return series.mask(mask, np.where(mask, corrected_values.take(codes), None)), mask
+
+
+def add_categories(series, values):
+    """Makes room in a categorical series for the values it's about to take on"""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    categories = series.cat.categories
+    new = [value for value in pd.unique(np.asarray(values, dtype=object)) if value not in categories]
+    return series.cat.add_categories(new) if new else series
+
+
+def autocorrect(df, rules):
+    """Applies every rule's autocorrect_dict to its column of df, returns a dict of rule column -> cells corrected"""
+    corrections = {}
     for field, rule in rules.items():
-        schemas_list.append(Column(field, [InListValidation(list(rule['allowed_value_set']))]))
+        df[field], mask = autocorrect_mask(df[field], rule)
+        corrections[field] = int(mask.sum())
+    return corrections
 
-    schema = Schema(schemas_list)
-    errors = schema.validate(df, columns=schema.get_column_names())
 
-    # reset progress bar
-    if progress:
-        progress.config(value=0)
-    
-    # increment progress bar #1
-    if progress:
-        progress.step(20)
+# Fewer rows than this are checked in this process even with workers: sending the columns over and the results
+# back takes longer than checking them here (about 5ms a column at 10k rows)
+PARALLEL_MIN_ROWS = 50000
 
 
-    ################################
-    #   BUILD SHEET W FORMATTING   #
-    ################################
+def check(df, rules, workers=None, pool=None):
+    """Autocorrects df in place, then validates what is left.
 
-    writer = pd.ExcelWriter(filepath, engine='xlsxwriter')
+    Returns (corrections, invalid): dicts of rule column -> cells corrected, boolean mask of flagged cells
+    With more than one worker, the rule columns of frames of PARALLEL_MIN_ROWS or more are spread over a pool of
+    processes: pool when given (one kept for a whole run of chunks), otherwise one made for df.
+    """
+    parallel = len(rules) > 1 and len(df) >= PARALLEL_MIN_ROWS
+    if pool is not None and parallel:
+        return check_parallel(df, rules, workers, pool)
+    if workers and workers > 1 and parallel:
+        return check_parallel(df, rules, workers)
+    corrections = autocorrect(df, rules)
+    return corrections, validate(df, rules)
 
-    # Skip row 1 headers so we can add manunally with formatting
-    df.to_excel(writer, sheet_name='Sheet1', startrow=1, header=False, index=False)
 
-    workbook = writer.book
-    worksheet = writer.sheets['Sheet1']
+# Frame being checked by a pool of workers. Forked workers inherit it copy-on-write, so column
+# data never has to be pickled over to them.
+_shared = {}
 
-    ### WORKBOOK FORMATS ###
-    yellow_highlight = workbook.add_format({'bg_color': '#FFEB9C' })
 
-    header = workbook.add_format({
-        'bold': True,
-        'text_wrap': True,
-        'valign': 'top',
-        'fg_color': '#D7E4BC',
-        'border': 1
-        })
+def check_column(field, rule, series=None):
+    """Autocorrects and validates one rule column in a worker process.
 
-    # increment progress bar #2
-    if progress:
-        progress.step(20)
+    Returns the column name, the packed mask of corrected cells, their corrected values and the packed mask
+    of flagged cells, so only the changes travel back to the parent.
+    """
+    if series is None:
+        series = _shared['df'][field]
+    corrected, corrected_mask = autocorrect_mask(series, rule)
+    invalid = invalid_mask(corrected, rule['allowed_value_set'])
+    return field, np.packbits(corrected_mask), corrected[corrected_mask].to_numpy(), np.packbits(invalid)
 
-    # Set column widths
-    worksheet.set_column(0, len(df.columns)-1, 22)
-    worksheet.set_default_row(hide_unused_rows=True)
 
-    # Write the column headers with the defined format.
-    for col_num, value in enumerate(df.columns.values):
-        worksheet.write(0, col_num, value, header)
+def pool_context():
+    # fork on Linux, so workers inherit data instead of having it pickled over. Elsewhere the platform's default:
+    # macOS has fork, but forking there isn't safe with the system libraries' threads
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
 
-    # increment progress bar #3
-    if progress:
-        progress.step(20)
 
-    flag_rows = []
-    df_length = len(df)
+def check_parallel(df, rules, workers, pool=None):
+    # Workers that already run (pool given), or that don't fork (e.g. on Windows), get sent just their own column,
+    # pickled: a copy of its category codes, one byte or two a row for rule columns, which are categorical.
+    # Only workers forked for df share it without a copy
+    if pool is not None:
+        futures = [pool.submit(check_column, field, rule, df[field]) for field, rule in rules.items()]
+        return collect_columns(df, futures)
 
-    for error in errors:
-        
-        # Catch Key errors, like rules_file, data_file column name mismatch
-        try:
-            row = error.row + 1
-            column = df.columns.get_loc(error.column)
-        except:
-            results.spreadsheet = None
-            results.errors.append("ERROR: " + str(error))
-            return results
-
-        # Catch other errors. Not sure what yet.
-        try:
-            # If an autocorrect mapping exists for value, replace it.
-            if error.value in rules[error.column]['autocorrect_dict'].keys():
-                worksheet.write(row, column, rules[error.column]['autocorrect_dict'][error.value])
-                results.corrections += 1
+    context = pool_context()
+    fork = context.get_start_method() == 'fork'
+    _shared['df'] = df
+    try:
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            futures = [pool.submit(check_column, field, rule, None if fork else df[field]) for field, rule in rules.items()]
+            return collect_columns(df, futures)
+    finally:
+        _shared.clear()
+
+
+def collect_columns(df, futures):
+    """Applies the corrections check_column sent back to df, returns (corrections, invalid) as check does"""
+    corrections = {}
+    invalid = {}
+    for future in futures:
+        field, corrected, values, flagged = future.result()
+        corrected = np.unpackbits(corrected, count=len(df)).astype(bool)
+        if corrected.any():
+            df[field] = add_categories(df[field], values).mask(corrected, pd.Series(values, index=df.index[corrected]))
+        corrections[field] = int(corrected.sum())
+        invalid[field] = np.unpackbits(flagged, count=len(df)).astype(bool)
+    return corrections, invalid
+
+
+# review tab for single sheet spreadsheets
+SHEET = 'Sheet1'
+
+
+def legal_options_message(allowed_value_set):
+    return 'is not in the list of legal options ({})'.format(', '.join(str(v) for v in allowed_value_set))
+
+
+def missing_columns(df, rules):
+    return ["ERROR: The column {} exists in the schema but not in the data frame".format(field)
+            for field in rules if field not in df.columns]
+
+
+def apply_edits(df, edits):
+    rows = edits.index.intersection(df.index)
+    for field in edits.columns:
+        df.loc[rows, field] = edits.loc[rows, field].values
+    return df
+
+
+def save_cleaned(results, destination, chunksize=100000):
+    """Writes the cleaned data to a csv file at destination (parquet, if destination ends in .parquet), picking up
+    any edits made to the review workbook after it was written.
+
+    When several sheets were checked, each tab goes to its own file, named after destination and the tab.
+    The run's timings are saved next to it, as <name>.timings.json.
+    """
+    stem, extension = os.path.splitext(destination)
+    with results.timings.stage('save') as stage:
+        save_tabs(results, destination, chunksize)
+        stage.rows += results.rows
+    results.timings.to_json(stem + '.timings.json')
+
+
+def save_tabs(results, destination, chunksize):
+    edited = results.written_at is not None and os.path.getmtime(results.spreadsheet) != results.written_at
+    stem, extension = os.path.splitext(destination)
+    parquet = extension.lower() == '.parquet'
+
+    for tab, cleaned_file in results.cleaned_files.items():
+        if len(results.cleaned_files) > 1:
+            destination = "{} - {}{}".format(stem, tab, extension)
+
+        # a full review workbook has every row, edited or not
+        if edited and not results.flagged_only:
+            df = pd.read_excel(results.spreadsheet, sheet_name=tab)
+            if parquet:
+                intermediate.write_frame_parquet(df, destination)
             else:
-                flag_rows.append(error.row)
-                # If no autocorrect mapping exists, highlight and annotate the entry
-                # Comments
-                worksheet.write_comment(row, column , error.message)
-                # Highlights
-                worksheet.conditional_format(row, column, row, column, {'type': 'no_errors', 'format': yellow_highlight})
-                results.flags += 1
-        except Exception as err:
-            results.spreadsheet = None
-            results.errors.append("ERROR: " + err)
-            return results
-            
-    # increment progress bar #4
-    if progress:
-        progress.step(20)
-
-    # Hide Rows that don't contain annotations
-    for i in range(df_length+1):
-        if i not in flag_rows:
-            worksheet.set_row(i + 1, None, None, {'hidden': True})
-
-    # increment progress bar #5
-    if progress:
-        progress.step(20)
-    
-    writer.save()
+                df.to_csv(destination)
+            continue
+
+        edits = read_edits(results.spreadsheet, tab) if edited else None
+        if parquet and edits is None:
+            intermediate.write_parquet(cleaned_file, destination)
+        elif parquet:
+            df = pd.concat([apply_edits(df, edits) for df in intermediate.read_batches(cleaned_file, chunksize, fill=False)])
+            intermediate.write_frame_parquet(df, destination)
+        else:
+            for i, df in enumerate(intermediate.read_batches(cleaned_file, chunksize, fill=False)):
+                df = df if edits is None else apply_edits(df, edits)
+                df.to_csv(destination, mode='w' if i == 0 else 'a', header=i == 0)
+
+
+def write_review(results, progress=None, cancel=None):
+    """Writes the review workbook to results.spreadsheet from the cleaned data and flags clean kept"""
+    with results.timings.stage('review') as stage:
+        writer = ReviewWriter(results.spreadsheet, list(results.cleaned_files), flagged_only=results.flagged_only,
+                              **results.review_options)
 
+        try:
+            for tab, cleaned_file in results.cleaned_files.items():
+                invalid = results.invalid[tab]
+                for df in intermediate.read_batches(cleaned_file, PROGRESS_ROWS):
+                    start = df.index[0] if len(df) else 0
+                    if start == 0:
+                        writer.start_sheet(tab, df.columns.values, results.flag_messages[tab])
+
+                    # Write the data, hiding rows (or with flagged_only, skipping rows) that don't contain annotations
+                    writer.write(df, chunk_masks(invalid, start, len(df)))
+                    stage.rows += len(df)
+                    report(progress, cancel, WRITING, stage.rows, results.rows, results.flags)
+        except Cancelled:
+            writer.abort()
+            raise
+
+        writer.close()
+    results.written_at = os.path.getmtime(results.spreadsheet)
+    return results
+
+
+################################
+#   PROGRESS                   #
+################################
+
+# rows written to the review workbook between progress updates
+PROGRESS_ROWS = 10000
+
+
+def fail(results, *errors):
+    results.spreadsheet = None
+    results.errors += errors
+    return results
+
+
+def read_error(err):
+    if isinstance(err, loaders.UnsupportedFormat):
+        return "ERROR: Unaccepted File Format"
+    return "ERROR: Unable to read file. " + str(err)
+
+
+def summarize(results):
     results.messages.append("SUCCESS:")
     results.messages.append("{} entries corrected".format(results.corrections))
     results.messages.append("{} entries flagged for review".format(results.flags))
+    if len(results.sheets) > 1:
+        for tab, counts in results.sheets.items():
+            results.messages.append("{}: {} corrected, {} flagged".format(tab, counts['corrections'], counts['flags']))
+    return results
+
+
+def clean_chunks(spreadsheet, rules, tempfolder, chunksize, progress=None, flagged_only=False, flags_sheet=False,
+                 comment_limit=COMMENT_LIMIT, workers=None, fmt=None, cancel=None, review=True, sheet_rules=None,
+                 sheet_names=(None,)):
+    """Streaming version of clean for files too big to hold in memory, in any format loaders can stream.
+
+    The input is read, corrected and validated chunksize rows at a time, each chunk appended to the cleaned data
+    in tempfolder, a sheet at a time for multi-sheet workbooks. The review workbook is then written from that,
+    which xlsxwriter streams to disk in constant_memory mode.
+    """
+    results = start_results(tempfolder, flagged_only, flags_sheet, comment_limit)
+    sheet_rules = rules_by_sheet(rules, sheet_rules, sheet_names)
+    multi_sheet = len(sheet_names) > 1
+
+    # the row count isn't known until the last chunk
+    report(progress, cancel, LOADING)
+
+    # one pool of workers for every chunk of the run, rather than one per chunk
+    pool = ProcessPoolExecutor(workers, mp_context=pool_context()) if workers and workers > 1 else None
+    try:
+        for sheet, rules in sheet_rules.items():
+            tab = sheet if multi_sheet else SHEET
+            errors = stream_sheet(results, spreadsheet, sheet, tab, rules, cleaned_path(tempfolder, tab, multi_sheet),
+                                  chunksize, fmt, workers, progress, cancel, multi_sheet, pool)
+            if errors:
+                return fail(results, *["{} (sheet {})".format(error, sheet) for error in errors] if multi_sheet else errors)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if not results.cleaned_files:
+        return fail(results, "ERROR: None of the sheets have the columns in the rules file")
+    skipped_sheets(results, sheet_rules, sheet_names)
+
+    report(progress, cancel, CHECKING, results.rows, results.rows, results.flags)
+
+    if review:
+        write_review(results, progress, cancel)
+    return summarize(results)
+
+
+def stream_sheet(results, spreadsheet, sheet, tab, rules, cleaned_file, chunksize, fmt=None, workers=None,
+                 progress=None, cancel=None, skip_unrelated=False, pool=None):
+    """Streams one sheet of spreadsheet (None for the first) through autocorrect and validation into cleaned_file,
+    adding it to results as tab.
+
+    Returns a list of errors, empty if there were none. With skip_unrelated, a sheet without any of the rule
+    columns is left out of results, with no errors. pool is the run's pool of workers, if any, see check.
+    """
+    timings = results.timings
+    try:
+        chunks = iter(loaders.load_chunks(spreadsheet, chunksize, fmt=fmt, categorical=list(rules), sheet=sheet))
+    except Exception as err:
+        return [read_error(err)]
+
+    writer = intermediate.IntermediateWriter(cleaned_file)
+    positions = {field: [] for field in rules}
+    rows = corrections = flags = 0
+    try:
+        while True:
+            with timings.stage('load') as stage:
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    # number rows by their position in the whole sheet
+                    chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+                    stage.rows += len(chunk)
+            if chunk is None:
+                break
+
+            if rows == 0:
+                errors = missing_columns(chunk, rules)
+                if errors and skip_unrelated and len(errors) == len(rules):
+                    return []
+                if errors:
+                    return errors
+
+            with timings.stage('check') as stage:
+                chunk_corrections, invalid = check(chunk, rules, workers, pool)
+                stage.rows += len(chunk)
+            corrections += sum(chunk_corrections.values())
+            flags += int(sum(mask.sum() for mask in invalid.values()))
+            for field, flagged in flagged_positions(invalid, rows).items():
+                positions[field].append(flagged)
+
+            with timings.stage('store') as stage:
+                writer.write(chunk)
+                stage.rows += len(chunk)
+            rows += len(chunk)
+
+            report(progress, cancel, CHECKING, results.rows + rows, None, results.flags + flags)
+    except Cancelled:
+        raise
+    except Exception as err:
+        return ["ERROR: " + str(err)]
+    finally:
+        writer.close()
+
+    results.cleaned_files[tab] = cleaned_file
+    results.invalid[tab] = {field: np.concatenate(flagged) if flagged else np.zeros(0, dtype=np.int64)
+                            for field, flagged in positions.items()}
+    results.flag_messages[tab] = {field: legal_options_message(rule['allowed_value_set']) for field, rule in rules.items()}
+    results.sheets[tab] = {'corrections': corrections, 'flags': flags}
+    results.corrections += corrections
+    results.flags += flags
+    results.rows += rows
+    return []
+
+
+def rules_by_sheet(rules, sheet_rules, sheet_names):
+    """Which rules to check each sheet against: sheet_rules when given (other sheets are left out), otherwise
+    rules for every sheet, as for inputs without sheets
+    """
+    # single table inputs (csv, parquet...) have no sheet names to pick rules by
+    if sheet_rules and list(sheet_names) != [None]:
+        return {sheet: sheet_rules[sheet] for sheet in sheet_names if sheet in sheet_rules}
+    return {sheet: rules for sheet in sheet_names}
+
+
+def select_sheet_rules(rules, sheet_fields):
+    """Maps each sheet to the rules it names (rules file sheets), from sheet -> list of rule names.
+
+    Raises ValueError for rule names the rules file doesn't have, rather than checking a sheet against less than
+    was asked for.
+    """
+    unknown = ["{} ({})".format(field, sheet) for sheet, fields in sheet_fields.items()
+               for field in fields if field not in rules]
+    if unknown:
+        raise ValueError("Rules not in the rules file: " + ", ".join(unknown))
+    return {sheet: {field: rules[field] for field in fields} for sheet, fields in sheet_fields.items()}
+
+
+def cleaned_path(tempfolder, tab, multi_sheet):
+    return tempfolder + ('/temporary_file.{}.arrow'.format(tab) if multi_sheet else '/temporary_file.arrow')
+
+
+def skipped_sheets(results, sheet_rules, sheet_names):
+    if len(sheet_names) > 1:
+        for sheet in sheet_names:
+            if sheet in sheet_rules and sheet not in results.cleaned_files:
+                results.messages.append("Sheet {} has none of the rule columns, skipped".format(sheet))
+
+
+def start_results(tempfolder, flagged_only=False, flags_sheet=False, comment_limit=COMMENT_LIMIT):
+    if not os.path.exists(tempfolder):
+            os.makedirs(tempfolder)
+    results = SpreadCheck(tempfolder +'/temporary_file.xlsx')
+    results.flagged_only = flagged_only
+    results.review_options = {'tempfolder': tempfolder, 'flags_sheet': flags_sheet, 'comment_limit': comment_limit}
     return results
+
+
+def check_sheet(spreadsheet, sheet, rules, fmt=None, workers=None, skip_unrelated=False):
+    """Loads one sheet of spreadsheet (None for the first), then autocorrects and validates it against rules.
+
+    Returns (df, corrections, invalid, errors, timings), the first three None if there were errors.
+    With skip_unrelated, a sheet without any of the rule columns comes back as all None, with no errors.
+    """
+    timings = Timings()
+    try:
+        with timings.stage('load') as stage:
+            # rule columns as categoricals, the rest left as read
+            df = loaders.load(spreadsheet, fmt=fmt, sheet=sheet, categorical=list(rules))
+            stage.rows += len(df)
+    except Exception as err:
+        return None, None, None, [read_error(err)], timings
+
+    # Catch rules_file, data_file column name mismatch
+    errors = missing_columns(df, rules)
+    if errors and skip_unrelated and len(errors) == len(rules):
+        return None, None, None, None, timings
+    if errors:
+        return None, None, None, errors, timings
+
+    # Autocorrect first, so only whatever autocorrect couldn't fix gets flagged
+    try:
+        with timings.stage('check') as stage:
+            corrections, invalid = check(df, rules, workers)
+            stage.rows += len(df)
+    except Exception as err:
+        return None, None, None, ["ERROR: " + str(err)], timings
+    return df, corrections, invalid, [], timings
+
+        
+def clean(spreadsheet, rules, tempfolder, progress=None, chunksize=None, flagged_only=False, flags_sheet=False,
+          comment_limit=COMMENT_LIMIT, workers=None, sheet_rules=None, cancel=None, review=True, profile=None):
+    """Autocorrects and validates spreadsheet against rules, keeping the cleaned data in tempfolder, and writes a
+    review workbook of the flagged entries there, or with review=False leaves that for write_review.
+
+    Every sheet of a multi-sheet workbook is checked, against sheet_rules[sheet name] when given (other sheets
+    are left out), otherwise against rules, skipping sheets that have none of the rule columns.
+    Sheets are checked in parallel with several workers, as are the rule columns of a single sheet.
+
+    progress:   called with a Progress at each stage and every PROGRESS_ROWS rows written
+    cancel:     a threading.Event (or anything with is_set); once set, the run stops at the next progress
+                update and returns with a cancelled error
+    profile:    path to dump a cProfile of the run to (this process only, not worker processes)
+    """
+
+    if not os.path.exists(tempfolder):
+            os.makedirs(tempfolder)
+    filepath = tempfolder +'/temporary_file.xlsx'
+
+    try:
+        fmt = loaders.sniff(spreadsheet)
+        sheet_names = loaders.sheet_names(spreadsheet, fmt)
+    except Exception as err:
+        return fail(SpreadCheck(filepath), read_error(err))
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        # stream the file in chunks when asked to, if its format allows
+        if chunksize and fmt in loaders.CHUNK_LOADERS:
+            return clean_chunks(spreadsheet, rules, tempfolder, chunksize, progress, flagged_only, flags_sheet,
+                                comment_limit, workers, fmt, cancel, review, sheet_rules, sheet_names)
+        return clean_sheets(spreadsheet, rules, tempfolder, progress, flagged_only, flags_sheet, comment_limit, workers,
+                            sheet_rules, fmt, sheet_names, cancel, review)
+    except Cancelled:
+        return fail(SpreadCheck(filepath), CANCELLED)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+
+
+def clean_sheets(spreadsheet, rules, tempfolder, progress=None, flagged_only=False, flags_sheet=False,
+                 comment_limit=COMMENT_LIMIT, workers=None, sheet_rules=None, fmt=None, sheet_names=(None,), cancel=None,
+                 review=True):
+    """Loads each sheet of spreadsheet whole, then checks it, see clean"""
+    results = start_results(tempfolder, flagged_only, flags_sheet, comment_limit)
+    sheet_rules = rules_by_sheet(rules, sheet_rules, sheet_names)
+    multi_sheet = len(sheet_names) > 1
+
+    ################################
+    #   LOAD, AUTOCORRECT, VALIDATE  #
+    ################################
+    report(progress, cancel, LOADING)
+    sheets = list(sheet_rules)
+    if workers and workers > 1 and len(sheets) > 1:
+        # a process per sheet, each loading its own sheet
+        with ProcessPoolExecutor(min(workers, len(sheets)), mp_context=pool_context()) as pool:
+            checked = list(pool.map(check_sheet, repeat(spreadsheet), sheets, sheet_rules.values(), repeat(fmt),
+                                    repeat(None), repeat(multi_sheet)))
+    else:
+        checked = []
+        for sheet in sheets:
+            checked.append(check_sheet(spreadsheet, sheet, sheet_rules[sheet], fmt, workers, multi_sheet))
+            report(progress, cancel, CHECKING, sum(len(df) for df, *_ in checked if df is not None))
+
+    errors = []
+    for sheet, (df, corrections, invalid, sheet_errors, timings) in zip(sheets, checked):
+        results.timings.merge(timings)
+        if sheet_errors:
+            errors += ["{} (sheet {})".format(error, sheet) for error in sheet_errors] if multi_sheet else sheet_errors
+    if errors:
+        return fail(results, *errors)
+    checked = [(sheet, result) for sheet, result in zip(sheets, checked) if result[0] is not None]
+    if not checked:
+        return fail(results, "ERROR: None of the sheets have the columns in the rules file")
+
+    # review tabs are named after the sheets, or Sheet1 for single sheet inputs.
+    # The cleaned data goes to tempfolder as Arrow, rather than staying in memory
+    tabs = [sheet for sheet, _ in checked] if multi_sheet else [SHEET]
+    for tab, (sheet, (df, corrections, invalid, *_)) in zip(tabs, checked):
+        cleaned_file = cleaned_path(tempfolder, tab, multi_sheet)
+        with results.timings.stage('store') as stage:
+            writer = intermediate.IntermediateWriter(cleaned_file)
+            writer.write(df)
+            writer.close()
+            stage.rows += len(df)
+
+        results.cleaned_files[tab] = cleaned_file
+        results.invalid[tab] = flagged_positions(invalid)
+        results.flag_messages[tab] = {field: legal_options_message(rule['allowed_value_set'])
+                                      for field, rule in sheet_rules[sheet].items()}
+        results.sheets[tab] = {
+            'corrections': sum(corrections.values()),
+            'flags': int(sum(len(flagged) for flagged in results.invalid[tab].values()))
+        }
+        results.corrections += results.sheets[tab]['corrections']
+        results.flags += results.sheets[tab]['flags']
+        results.rows += len(df)
+    skipped_sheets(results, sheet_rules, sheet_names)
+
+    report(progress, cancel, CHECKING, results.rows, results.rows, results.flags)
+
+    if review:
+        write_review(results, progress, cancel)
+    return summarize(results)
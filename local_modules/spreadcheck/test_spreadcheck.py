@@ -0,0 +1,474 @@
+import json
+import os
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+from local_modules.spreadcheck import batch, intermediate, loaders, review, spreadcheck
+
+
+rules = {'Gender': {'allowed_value_set': {'M', 'F', 'Unknown', 'Other'},
+                    'autocorrect_dict': {'male': 'M', 'Female': 'F', 'unk': 'Unknown'}},
+         'Zip': {'allowed_value_set': {19001, 19002},
+                 'autocorrect_dict': {}}}
+
+d = {'First Name': ["John", "Cindy", "Mario", "Albert", "Jon"],
+     'Gender': ["M", "Female", "F", "X", "unk"],
+     'Zip': [19001, 19002, 19003, 19001, 12345]}
+
+
+def test_invalid_mask_marks_values_outside_allowed_set():
+    mask = spreadcheck.invalid_mask(pd.Series(d['Gender']), rules['Gender']['allowed_value_set'])
+    assert mask.tolist() == [False, True, False, True, True]
+
+
+def test_invalid_mask_flags_missing_values():
+    mask = spreadcheck.invalid_mask(pd.Series(["M", None, np.nan]), {'M'})
+    assert mask.tolist() == [False, True, True]
+
+
+def test_validate_returns_one_mask_per_rule_column():
+    invalid = spreadcheck.validate(pd.DataFrame(data=d), rules)
+    assert set(invalid) == {'Gender', 'Zip'}
+    assert np.flatnonzero(invalid['Zip']).tolist() == [2, 4]
+
+
+def test_clean_counts_corrections_and_flags(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert results.errors == []
+    assert results.corrections == 2
+    assert results.flags == 3
+
+
+def test_clean_reports_rule_column_missing_from_data(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).drop(columns="Zip").to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert results.spreadsheet is None
+    assert results.errors == ["ERROR: The column Zip exists in the schema but not in the data frame"]
+
+
+def test_autocorrect_maps_columns_and_counts_corrections():
+    df = pd.DataFrame(data=d)
+    corrections = spreadcheck.autocorrect(df, rules)
+    assert corrections == {'Gender': 2, 'Zip': 0}
+    assert df['Gender'].tolist() == ["M", "F", "F", "X", "Unknown"]
+
+
+def test_autocorrect_leaves_allowed_values_alone():
+    rule = {'allowed_value_set': {'M', 'F'}, 'autocorrect_dict': {'M': 'F', 'male': 'M'}}
+    corrected, mask = spreadcheck.autocorrect_mask(pd.Series(["M", "male", None]), rule)
+    assert corrected.tolist() == ["M", "M", None]
+    assert mask.tolist() == [False, True, False]
+
+
+def test_check_treats_missing_values_as_null_and_leaves_other_columns_alone():
+    null_rules = {'Gender': {'allowed_value_set': {'M', 'F', 'NULL'}, 'autocorrect_dict': {}},
+                  'Zip': {'allowed_value_set': {19001}, 'autocorrect_dict': {'NULL': 19001}},
+                  'Race': {'allowed_value_set': {'White'}, 'autocorrect_dict': {}}}
+    df = pd.DataFrame({'Gender': ["M", None, "F"], 'Zip': [19001, np.nan, 19001], 'Race': ["White", None, "White"],
+                       'Age': [30, np.nan, 40]})
+    corrections, invalid = spreadcheck.check(df, null_rules)
+    assert corrections == {'Gender': 0, 'Zip': 1, 'Race': 0}
+    assert df['Zip'].tolist() == [19001, 19001, 19001]
+    assert {field: mask.tolist() for field, mask in invalid.items()} == \
+        {'Gender': [False, False, False], 'Zip': [False, False, False], 'Race': [False, True, False]}
+    assert df['Age'].dtype == np.float64
+
+
+def test_clean_keeps_corrected_data_in_memory(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert results.dataframe['Gender'].tolist() == ["M", "F", "F", "X", "Unknown"]
+
+
+def test_clean_in_chunks_matches_whole_file(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    whole = spreadcheck.clean(str(data_file), rules, str(tmp_path / "whole"))
+    chunked = spreadcheck.clean(str(data_file), rules, str(tmp_path / "chunked"), chunksize=2)
+    assert (chunked.corrections, chunked.flags) == (whole.corrections, whole.flags)
+    assert chunked.dataframe.equals(whole.dataframe)
+    assert pd.read_excel(chunked.spreadsheet).equals(pd.read_excel(whole.spreadsheet))
+
+
+def test_flagged_only_review_holds_just_the_flagged_rows(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), flagged_only=True)
+    flagged = pd.read_excel(results.spreadsheet)
+    assert flagged[review.ORIGINAL_ROW].tolist() == [4, 5, 6]
+    assert flagged['First Name'].tolist() == ["Mario", "Albert", "Jon"]
+    assert results.dataframe['First Name'].tolist() == d['First Name']
+
+
+def test_save_cleaned_picks_up_edits_to_flagged_only_review(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    for chunksize in (None, 2):
+        results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), chunksize=chunksize, flagged_only=True)
+        flagged = pd.read_excel(results.spreadsheet)
+        flagged.loc[1, 'Gender'] = "M"
+        flagged.to_excel(results.spreadsheet, index=False)
+        os.utime(results.spreadsheet, (0, 0))
+
+        spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.csv"))
+        cleaned = pd.read_csv(tmp_path / "cleaned.csv", index_col=0)
+        assert cleaned['Gender'].tolist() == ["M", "F", "F", "M", "Unknown"]
+
+
+def test_review_workbook_hides_clean_rows_and_annotates_flags(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    worksheet = openpyxl.load_workbook(results.spreadsheet).active
+    assert [row for row in range(2, 7) if worksheet.row_dimensions[row].hidden] == [2, 3]
+    assert worksheet['A2'].value == "John"
+    assert worksheet['B3'].value == "F"
+    assert [cell for cell in ("B5", "C4", "C6") if worksheet[cell].comment] == ["B5", "C4", "C6"]
+
+
+def test_flags_sheet_lists_flags_with_links_and_caps_comments(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), flags_sheet=True, comment_limit=1)
+    workbook = openpyxl.load_workbook(results.spreadsheet)
+    worksheet = workbook['Sheet1']
+    flags = pd.read_excel(results.spreadsheet, sheet_name=review.FLAGS_SHEET)
+    assert flags.values.tolist()[0][:3] == [4, 'Zip', 19003]
+    assert sorted(flags['Row']) == [4, 5, 6]
+    assert workbook[review.FLAGS_SHEET]['A2'].hyperlink.location == "'Sheet1'!C4"
+    assert [cell for cell in ("B5", "C4", "C6") if worksheet[cell].fill.fgColor.rgb.endswith("FFEB9C")] == ["B5", "C4", "C6"]
+    assert len([cell for cell in ("B5", "C4", "C6") if worksheet[cell].comment]) == 1
+
+
+def test_flags_past_the_comment_limit_go_on_a_flags_sheet(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), comment_limit=1)
+    workbook = openpyxl.load_workbook(results.spreadsheet)
+    assert workbook.sheetnames == ['Sheet1', review.FLAGS_SHEET]
+    flags = pd.read_excel(results.spreadsheet, sheet_name=review.FLAGS_SHEET)
+    commented = [cell for cell in ("B5", "C4", "C6") if workbook['Sheet1'][cell].comment]
+    assert len(commented) == 1 and len(flags) == 2
+
+    # within the limit, there is no Flags sheet unless asked for
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert openpyxl.load_workbook(results.spreadsheet).sheetnames == ['Sheet1']
+
+
+def test_sniff_goes_by_content_before_extension(tmp_path):
+    df = pd.DataFrame(data=d)
+    df.to_excel(tmp_path / "data.csv", index=False)
+    df.to_parquet(tmp_path / "data.parquet")
+    df.to_feather(tmp_path / "data.feather")
+    df.to_csv(tmp_path / "data.tsv", sep='\t', index=False)
+    df.to_csv(tmp_path / "data.dat", index=False)
+    assert [loaders.sniff(str(tmp_path / name)) for name in ("data.csv", "data.parquet", "data.feather", "data.tsv", "data.dat")] \
+        == ['xlsx', 'parquet', 'feather', 'tsv', 'csv']
+
+
+def test_load_reads_selected_columns(tmp_path):
+    pd.DataFrame(data=d).to_parquet(tmp_path / "data.parquet")
+    df = loaders.load(str(tmp_path / "data.parquet"), columns=['Gender'])
+    assert df.columns.tolist() == ['Gender']
+
+
+def test_load_reads_rule_columns_as_categoricals_and_keeps_text_in_arrow(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).assign(Tested=["2020-03-07"] * 5).to_csv(data_file, index=False)
+    df = loaders.load(str(data_file), categorical=['Gender', 'Zip'])
+    assert isinstance(df['Gender'].dtype, pd.CategoricalDtype)
+    assert set(df['Zip'].cat.categories) == {19001, 19002, 19003, 12345}
+    assert df['First Name'].dtype == pd.StringDtype('pyarrow')
+    # dates come out as they went in
+    assert df['Tested'].tolist() == ["2020-03-07"] * 5
+
+
+def test_autocorrect_adds_categories_for_corrected_values():
+    series = pd.Series(["male", None, "F", "X"], dtype='category')
+    corrected, mask = spreadcheck.autocorrect_mask(series, rules['Gender'])
+    assert isinstance(corrected.dtype, pd.CategoricalDtype)
+    assert corrected.astype(object).where(corrected.notna(), None).tolist() == ["M", None, "F", "X"]
+    assert mask.tolist() == [True, False, False, False]
+
+
+def test_clean_accepts_columnar_inputs(tmp_path):
+    pd.DataFrame(data=d).to_parquet(tmp_path / "data.parquet")
+    for chunksize in (None, 2):
+        results = spreadcheck.clean(str(tmp_path / "data.parquet"), rules, str(tmp_path / "temp"), chunksize=chunksize)
+        assert (results.corrections, results.flags) == (2, 3)
+
+
+def test_clean_reports_csv_parse_errors(tmp_path):
+    data_file = tmp_path / "data.csv"
+    data_file.write_text('Gender,Zip\nM,19001\nF,19002,extra\n')
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert results.errors[0].startswith("ERROR: Unable to read file. Error tokenizing data")
+
+
+def test_parallel_check_matches_serial_check(monkeypatch):
+    monkeypatch.setattr(spreadcheck, 'PARALLEL_MIN_ROWS', 0)
+    serial = pd.DataFrame(data=d)
+    parallel = pd.DataFrame(data=d)
+    corrections, invalid = spreadcheck.check(serial, rules)
+    parallel_corrections, parallel_invalid = spreadcheck.check(parallel, rules, workers=2)
+    assert parallel_corrections == corrections
+    assert {field: mask.tolist() for field, mask in parallel_invalid.items()} == \
+        {field: mask.tolist() for field, mask in invalid.items()}
+    assert parallel.equals(serial)
+
+
+def test_small_frames_are_checked_without_workers(monkeypatch):
+    monkeypatch.setattr(spreadcheck, 'check_parallel', None)
+    corrections, _ = spreadcheck.check(pd.DataFrame(data=d), rules, workers=2)
+    assert corrections == {'Gender': 2, 'Zip': 0}
+
+
+def test_streamed_parallel_check_uses_one_pool_per_run(tmp_path, monkeypatch):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    pools = []
+
+    class CountedPool(spreadcheck.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(spreadcheck, 'ProcessPoolExecutor', CountedPool)
+    monkeypatch.setattr(spreadcheck, 'PARALLEL_MIN_ROWS', 0)
+    serial = spreadcheck.clean(str(data_file), rules, str(tmp_path / "serial"), chunksize=2)
+    parallel = spreadcheck.clean(str(data_file), rules, str(tmp_path / "parallel"), chunksize=2, workers=2)
+    assert len(pools) == 1
+    assert parallel.sheets == serial.sheets
+    assert {field: flagged.tolist() for field, flagged in parallel.invalid['Sheet1'].items()} == \
+        {field: flagged.tolist() for field, flagged in serial.invalid['Sheet1'].items()}
+
+
+def write_workbook(path, sheets):
+    with pd.ExcelWriter(path) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+
+
+def test_clean_checks_every_sheet_of_a_workbook(tmp_path):
+    data_file = tmp_path / "data.xlsx"
+    notes = pd.DataFrame({'Note': ["a", "b"]})
+    write_workbook(data_file, {'Cases': pd.DataFrame(data=d), 'Notes': notes, 'More': pd.DataFrame(data=d).head(3)})
+    for workers in (None, 2):
+        results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), workers=workers)
+        assert results.errors == []
+        assert results.sheets == {'Cases': {'corrections': 2, 'flags': 3}, 'More': {'corrections': 1, 'flags': 1}}
+        assert (results.corrections, results.flags) == (3, 4)
+        assert "Sheet Notes has none of the rule columns, skipped" in results.messages
+        assert openpyxl.load_workbook(results.spreadsheet).sheetnames == ['Cases', 'More']
+
+    spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.csv"))
+    cleaned = pd.read_csv(tmp_path / "cleaned - More.csv", index_col=0)
+    assert cleaned['Gender'].tolist() == ["M", "F", "F"]
+
+
+def test_clean_streams_workbooks_sheet_by_sheet(tmp_path):
+    data_file = tmp_path / "data.xlsx"
+    notes = pd.DataFrame({'Note': ["a", "b"]})
+    write_workbook(data_file, {'Cases': pd.DataFrame(data=d), 'Notes': notes, 'More': pd.DataFrame(data=d).head(3)})
+    whole = spreadcheck.clean(str(data_file), rules, str(tmp_path / "whole"))
+    chunked = spreadcheck.clean(str(data_file), rules, str(tmp_path / "chunked"), chunksize=2)
+    assert chunked.errors == []
+    assert chunked.sheets == whole.sheets
+    assert chunked.messages == whole.messages
+    # flagged cells are kept as their row positions in the whole sheet
+    assert chunked.invalid['Cases']['Zip'].tolist() == [2, 4]
+    for tab in ('Cases', 'More'):
+        assert [mask.tolist() for mask in chunked.invalid[tab].values()] == [mask.tolist() for mask in whole.invalid[tab].values()]
+        chunked_review, whole_review = (pd.read_excel(results.spreadsheet, sheet_name=tab) for results in (chunked, whole))
+        assert chunked_review.equals(whole_review)
+
+    chunks = list(loaders.load_chunks(str(data_file), 2, sheet='Cases'))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert pd.concat(chunks, ignore_index=True).equals(pd.read_excel(data_file, sheet_name='Cases'))
+
+
+def test_excel_chunks_keep_number_columns_float_once_a_float_shows_up(tmp_path):
+    data_file = tmp_path / "data.xlsx"
+    write_workbook(data_file, {'Cases': pd.DataFrame({'Age': [1.5, None, 3, 4, 5]})})
+    chunks = list(loaders.load_chunks(str(data_file), 2))
+    assert [str(chunk['Age'].dtype) for chunk in chunks] == ['float64'] * 3
+    assert pd.concat(chunks, ignore_index=True).equals(pd.read_excel(data_file))
+
+
+def test_clean_checks_sheets_against_their_own_rules(tmp_path):
+    data_file = tmp_path / "data.xlsx"
+    write_workbook(data_file, {'Cases': pd.DataFrame(data=d), 'Zips': pd.DataFrame(data=d)[['Zip']]})
+    sheet_rules = {'Cases': {'Gender': rules['Gender']}, 'Zips': {'Zip': rules['Zip']}}
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), flags_sheet=True, sheet_rules=sheet_rules)
+    assert results.sheets == {'Cases': {'corrections': 2, 'flags': 1}, 'Zips': {'corrections': 0, 'flags': 2}}
+    flags = pd.read_excel(results.spreadsheet, sheet_name=review.FLAGS_SHEET)
+    assert flags[['Sheet', 'Row', 'Column']].values.tolist() == [['Cases', 5, 'Gender'], ['Zips', 4, 'Zip'], ['Zips', 6, 'Zip']]
+
+
+def test_clean_checks_single_table_inputs_against_all_rules_when_sheets_have_rules(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    sheet_rules = {'Cases': {'Gender': rules['Gender']}}
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), sheet_rules=sheet_rules)
+    assert results.errors == []
+    assert results.corrections == 2
+    assert results.flags == 3
+
+
+def test_select_sheet_rules_rejects_unknown_rule_names():
+    assert spreadcheck.select_sheet_rules(rules, {'Cases': ['Gender']}) == {'Cases': {'Gender': rules['Gender']}}
+    with pytest.raises(ValueError, match="Gendr"):
+        spreadcheck.select_sheet_rules(rules, {'Cases': ['Gendr', 'Zip']})
+
+
+def test_clean_batch_writes_outputs_and_summary(tmp_path):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    pd.DataFrame(data=d).to_csv(inputs / "one.csv", index=False)
+    pd.DataFrame(data=d).head(2).to_parquet(inputs / "two.parquet")
+    pd.DataFrame(data=d).drop(columns="Zip").to_csv(inputs / "three.csv", index=False)
+    (inputs / "~$one.xlsx").write_text("lock")
+
+    spreadsheets = batch.find_inputs([str(inputs)])
+    assert [os.path.basename(path) for path in spreadsheets] == ["one.csv", "three.csv", "two.parquet"]
+    for workers in (None, 2):
+        results = batch.clean_batch(spreadsheets, rules, str(tmp_path / "out"), workers)
+        assert [row[1:3] for row in batch.summary_rows(results)] == [[2, 3], [0, 0], [1, 0], [3, 3]]
+    assert sorted(os.listdir(tmp_path / "out")) == \
+        ["one.csv", "one.timings.json", "one_review.xlsx", "two.csv", "two.timings.json", "two_review.xlsx"]
+    assert pd.read_csv(tmp_path / "out" / "one.csv", index_col=0)['Gender'].tolist() == ["M", "F", "F", "X", "Unknown"]
+
+
+def test_clean_batch_carries_on_past_a_file_that_fails_to_save(tmp_path, monkeypatch):
+    inputs = tmp_path / "inputs"
+    inputs.mkdir()
+    for name in ("one.csv", "two.csv"):
+        pd.DataFrame(data=d).to_csv(inputs / name, index=False)
+    save_cleaned = spreadcheck.save_cleaned
+
+    def fail_on_one(results, destination, *args):
+        if os.path.basename(destination) == "one.csv":
+            raise OSError("disk full")
+        return save_cleaned(results, destination, *args)
+
+    monkeypatch.setattr(spreadcheck, 'save_cleaned', fail_on_one)
+    results = batch.clean_batch(batch.find_inputs([str(inputs)]), rules, str(tmp_path / "out"))
+    assert [result.errors for _, result in results] == [["ERROR: disk full"], []]
+    assert os.path.exists(tmp_path / "out" / "two_review.xlsx")
+
+
+def test_clean_batch_keeps_outputs_of_inputs_with_the_same_stem_apart(tmp_path):
+    inputs = tmp_path / "inputs"
+    (inputs / "more").mkdir(parents=True)
+    pd.DataFrame(data=d).to_csv(inputs / "data.csv", index=False)
+    pd.DataFrame(data=d).head(2).to_parquet(inputs / "data.parquet")
+    results = batch.clean_batch(batch.find_inputs([str(inputs)]), rules, str(tmp_path / "out"))
+    assert [result.errors for _, result in results] == [[], []]
+    assert sorted(os.listdir(tmp_path / "out")) == \
+        ["data.csv.csv", "data.csv.timings.json", "data.csv_review.xlsx",
+         "data.parquet.csv", "data.parquet.timings.json", "data.parquet_review.xlsx"]
+
+    pd.DataFrame(data=d).to_csv(inputs / "more" / "data.csv", index=False)
+    with pytest.raises(ValueError, match="data.csv"):
+        batch.clean_batch([str(inputs / "data.csv"), str(inputs / "more" / "data.csv")], rules, str(tmp_path / "again"))
+    assert not os.path.exists(tmp_path / "again")
+
+
+def test_clean_reports_progress_to_callback(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    for chunksize in (None, 2):
+        events = []
+        results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), events.append, chunksize=chunksize)
+        assert results.errors == []
+        assert events[0].stage == spreadcheck.LOADING
+        assert events[-1] == spreadcheck.Progress(spreadcheck.WRITING, 5, 5, 3)
+    assert [(event.rows, event.total) for event in events if event.stage == spreadcheck.CHECKING] == \
+        [(2, None), (4, None), (5, None), (5, 5)]
+
+
+def test_clean_stops_when_cancelled(tmp_path):
+    class CancelAfter:
+        def __init__(self, updates):
+            self.updates = updates
+
+        def is_set(self):
+            self.updates -= 1
+            return self.updates < 0
+
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    for chunksize in (None, 2):
+        results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), chunksize=chunksize, cancel=CancelAfter(2))
+        assert results.errors == [spreadcheck.CANCELLED]
+        assert not os.path.exists(tmp_path / "temp" / "temporary_file.xlsx")
+
+
+def test_review_workbook_is_written_only_when_asked_for(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), review=False)
+    assert results.errors == []
+    assert not os.path.exists(results.spreadsheet)
+
+    spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.csv"))
+    assert pd.read_csv(tmp_path / "cleaned.csv", index_col=0)['Gender'].tolist() == ["M", "F", "F", "X", "Unknown"]
+
+    spreadcheck.write_review(results)
+    expected = spreadcheck.clean(str(data_file), rules, str(tmp_path / "expected"))
+    assert pd.read_excel(results.spreadsheet).equals(pd.read_excel(expected.spreadsheet))
+
+
+def test_save_cleaned_leaves_missing_values_missing(tmp_path):
+    data_file = tmp_path / "data.csv"
+    df = pd.DataFrame(data=d)
+    df.loc[1, 'First Name'] = None
+    df.to_csv(data_file, index=False)
+    results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"))
+    assert results.dataframe.loc[1, 'First Name'] == "NULL"
+
+    spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.csv"))
+    # NULL is only how the review workbook shows them
+    assert pd.read_csv(tmp_path / "cleaned.csv", keep_default_na=False).loc[1, 'First Name'] == ""
+
+    spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.parquet"))
+    cleaned = pd.read_parquet(tmp_path / "cleaned.parquet")
+    assert cleaned['First Name'].isna().tolist() == [False, True, False, False, False]
+    assert cleaned['Zip'].tolist() == d['Zip']
+
+
+def test_intermediate_starts_new_segment_when_column_types_change(tmp_path):
+    folder = str(tmp_path / "cleaned.arrow")
+    writer = intermediate.IntermediateWriter(folder)
+    writer.write(pd.DataFrame({'Zip': [19001, 19002]}))
+    writer.write(pd.DataFrame({'Zip': ["NULL", "19003-1234"]}, index=[2, 3]))
+    writer.close()
+    assert len(intermediate.segments(folder)) == 2
+    assert intermediate.read_frame(folder)['Zip'].tolist() == [19001, 19002, "NULL", "19003-1234"]
+
+    intermediate.write_parquet(folder, str(tmp_path / "cleaned.parquet"))
+    assert pd.read_parquet(tmp_path / "cleaned.parquet")['Zip'].tolist() == ["19001", "19002", None, "19003-1234"]
+
+
+def test_clean_records_stage_timings(tmp_path):
+    data_file = tmp_path / "data.csv"
+    pd.DataFrame(data=d).to_csv(data_file, index=False)
+    for chunksize in (None, 2):
+        results = spreadcheck.clean(str(data_file), rules, str(tmp_path / "temp"), chunksize=chunksize,
+                                    profile=str(tmp_path / "clean.prof"))
+        spreadcheck.save_cleaned(results, str(tmp_path / "cleaned.csv"))
+        assert list(results.timings.stages) == ['load', 'check', 'store', 'review', 'save']
+        assert all(stage.rows == 5 for stage in results.timings.stages.values())
+        assert os.path.getsize(tmp_path / "clean.prof") > 0
+
+    with open(tmp_path / "cleaned.timings.json") as f:
+        timings = json.load(f)
+    assert [stage['stage'] for stage in timings['stages']] == ['load', 'check', 'store', 'review', 'save']
+    assert timings['seconds'] == pytest.approx(sum(stage['seconds'] for stage in timings['stages']), abs=1e-3)
@@ -0,0 +1,103 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+# Per-stage instrumentation for spreadcheck runs: wall time, rows handled and the process's peak memory.
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far, in MB, None where the platform doesn't say"""
+    # linux keeps getrusage's peak across exec, so a spawned process would start with its parent's.
+    # The high-water mark in /proc is the process's own
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = 0
+        # peak memory of the process at the end of the stage, so the stage that raised it is the one that hit it
+        self.peak_memory_mb = None
+
+    @property
+    def rows_per_sec(self):
+        return round(self.rows / self.seconds) if self.rows and self.seconds else None
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'seconds': round(self.seconds, 4),
+            'rows': self.rows,
+            'rows_per_sec': self.rows_per_sec,
+            'peak_memory_mb': self.peak_memory_mb
+        }
+
+
+class Timings:
+    """Stages of a run in the order they first ran. Stages run more than once (e.g. per chunk) add up."""
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as stage name, yielding the Stage so the block can add the rows it handled"""
+        stage = self.stages.setdefault(name, Stage(name))
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+            stage.peak_memory_mb = peak_memory_mb()
+
+    def merge(self, other):
+        """Adds the stages of other, e.g. timings sent back from a worker process"""
+        for name, theirs in other.stages.items():
+            stage = self.stages.setdefault(name, Stage(name))
+            stage.seconds += theirs.seconds
+            stage.rows += theirs.rows
+            stage.peak_memory_mb = max(filter(None, [stage.peak_memory_mb, theirs.peak_memory_mb]), default=None)
+
+    @property
+    def seconds(self):
+        return sum(stage.seconds for stage in self.stages.values())
+
+    def as_dict(self):
+        return {
+            'seconds': round(self.seconds, 4),
+            'peak_memory_mb': max(filter(None, (stage.peak_memory_mb for stage in self.stages.values())), default=None),
+            'stages': [stage.as_dict() for stage in self.stages.values()]
+        }
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self):
+        """One line per stage, for showing to people"""
+        lines = []
+        for stage in self.stages.values():
+            line = "{}: {:.2f}s".format(stage.name, stage.seconds)
+            if stage.rows_per_sec:
+                line += ", {:,} rows/s".format(stage.rows_per_sec)
+            if stage.peak_memory_mb:
+                line += ", peak {:,.0f} MB".format(stage.peak_memory_mb)
+            lines.append(line)
+        return lines
@@ -1,10 +1,38 @@
 import tkinter as tk
 from tkinter import ttk, Menu, filedialog, messagebox, font
 from configparser import ConfigParser
-from local_modules.spreadcheck import spreadcheck
-from local_modules.autocorrect import autocorrect
-import sys, subprocess, platform, os, shutil, glob, atexit
-import pandas as pd
+from local_modules.spreadcheck import progress
+import sys, subprocess, platform, os, shutil, glob, atexit, multiprocessing, queue, threading
+
+
+# milliseconds between checks for progress from a running validation
+POLL_INTERVAL = 100
+
+# share of the progress bar each validation stage fills
+STAGE_PROGRESS = {
+    progress.LOADING: (0, 20),
+    progress.CHECKING: (20, 40),
+    progress.WRITING: (40, 100),
+}
+
+# milliseconds after the window opens before loading the data modules in the background
+PRELOAD_DELAY = 100
+
+
+def data_modules():
+    """Imports and returns spreadcheck and autocorrect.
+
+    They bring in pandas, pyarrow and xlsxwriter, seconds of loading in the frozen build, so they're left out of this
+    module's imports to get the window up first. preload() imports them on a background thread while the user is
+    on StartPage and Setup; called before that's done, this waits for it.
+    """
+    from local_modules.spreadcheck import spreadcheck
+    from local_modules.autocorrect import autocorrect
+    return spreadcheck, autocorrect
+
+
+def preload():
+    threading.Thread(target=data_modules, daemon=True).start()
 
 
 class tkinterApp(tk.Tk):
@@ -16,6 +44,8 @@ class tkinterApp(tk.Tk):
 
         # get previous file paths from config.ini
         self.config_file = ConfigParser()
+        # keep the case of keys, [SHEET_RULES] keys are sheet names
+        self.config_file.optionxform = str
         self.config_file.read('config.ini')
 
         # TODO: decouple data & paths from this class
@@ -23,8 +53,29 @@ class tkinterApp(tk.Tk):
         self.rules_file = self.config_file['FILE_PATHS']['rules_file']
         self.write_dir = self.config_file['FILE_PATHS']['write_dir']
         self.temp_dir = self.config_file['FILE_PATHS']['temp_dir']
+
+        # rows per chunk when streaming large csv files, blank to load whole files
+        chunksize = self.config_file.get('VALIDATION', 'chunksize', fallback='')
+        self.chunksize = int(chunksize) if chunksize else None
+        # review only the flagged rows instead of the whole spreadsheet with clean rows hidden
+        self.flagged_only = self.config_file.getboolean('VALIDATION', 'flagged_only', fallback=False)
+        # list flags on a separate sheet, and cap how many flagged cells also get a comment (blank for no cap).
+        # The fallback is review.COMMENT_LIMIT, not imported here as it would pull in the data modules
+        self.flags_sheet = self.config_file.getboolean('VALIDATION', 'flags_sheet', fallback=False)
+        comment_limit = self.config_file.get('VALIDATION', 'comment_limit', fallback='1000')
+        self.comment_limit = int(comment_limit) if comment_limit else None
+        # processes to spread rule columns over, blank to check them in this process
+        workers = self.config_file.get('VALIDATION', 'workers', fallback='')
+        self.workers = int(workers) if workers else None
+        # dump a cProfile of each validation run to temp_dir/validation.prof
+        self.profile = self.config_file.getboolean('VALIDATION', 'profile', fallback=False)
+        # input sheet -> the rules (rules file sheets) to check it against, empty to check every sheet against all of them
+        sheet_rules = self.config_file['SHEET_RULES'] if self.config_file.has_section('SHEET_RULES') else {}
+        self.sheet_rules = {sheet: [field.strip() for field in fields.split(',')] for sheet, fields in sheet_rules.items()}
+
         self.default_save_filename = tk.StringVar()
         self.data_file = ""
+        self.results = None
 
         self.titlefont = font.Font(family="Verdana", size=12, weight="bold")
         
@@ -151,7 +202,11 @@ class Setup(tk.Frame):
         controller.data_file = filedialog.askopenfilename(filetypes=[
             ("spreadsheeet format", ".xlsx"),
             ("spreadsheeet format", ".xls"),
-            ("spreadsheet format", ".csv")
+            ("spreadsheet format", ".csv"),
+            ("spreadsheet format", ".tsv"),
+            ("columnar format", ".parquet"),
+            ("columnar format", ".feather"),
+            ("columnar format", ".arrow")
         ])
 
         base = os.path.basename(controller.data_file)
@@ -191,11 +246,11 @@ class Validate(tk.Frame):
         options_frame.grid_columnconfigure(1, weight=1)
 
         # Run Validation button
-        validate_button = ttk.Button(options_frame, text="Run Validation", command= lambda: self.run_validation(controller, self.progress))
-        validate_button.grid(row = 0, column = 0, padx = 12, pady = 10, sticky = "w")
+        self.validate_button = ttk.Button(options_frame, text="Run Validation", command= lambda: self.run_validation(controller))
+        self.validate_button.grid(row = 0, column = 0, padx = 12, pady = 10, sticky = "w")
 
         # View Invalid Entries Button
-        self.data_file_button = ttk.Button(options_frame, text="View Flagged Entries", command= lambda: controller.open_file(controller.data_file))
+        self.data_file_button = ttk.Button(options_frame, text="View Flagged Entries", command= lambda: self.view_flagged(controller))
         self.data_file_button.grid(row = 0, column = 1, padx = 12, pady = 10, sticky = "ew")
         self.data_file_button.state(["disabled"])
         
@@ -220,28 +275,158 @@ class Validate(tk.Frame):
         self.next_button.grid(row = 4, column = 0, padx = 10, pady = 10, sticky="e")
         self.next_button.state(["disabled"])
 
-    def run_validation(self, controller, progress):
-        
-        results = spreadcheck.clean(controller.data_file, autocorrect.fields(controller.rules_file), controller.temp_dir, progress)
-        
+        # Stop a running validation
+        self.cancel_button = ttk.Button(self, text ="Cancel", command = self.cancel_validation)
+        self.cancel_button.grid(row = 4, column = 0, padx = 10, pady = 10, sticky="w")
+        self.cancel_button.state(["disabled"])
+
+        self.events = queue.Queue()
+        self.cancel = threading.Event()
+
+    def run_validation(self, controller):
+        # validation runs on a worker thread, which posts progress events to a queue polled from the Tk event loop,
+        # so the window stays responsive however long it takes
+        self.validate_button.state(["disabled"])
+        self.data_file_button.state(["disabled"])
+        self.next_button.state(["disabled"])
+        self.cancel_button.state(["!disabled"])
+        self.progress.config(value=0)
+        self.show_message(["Starting validation..."], "black")
+
+        self.start_worker(self.validate, controller, lambda results: self.finish_validation(controller, results))
+
+    def start_worker(self, target, argument, finish):
+        # target(argument, events, cancel) runs on a worker thread, finish(result) back on the Tk thread once it
+        # has put its result on the queue
+        self.events = queue.Queue()
+        self.cancel = threading.Event()
+        worker = threading.Thread(target=target, args=(argument, self.events, self.cancel), daemon=True)
+        worker.start()
+        self.after(POLL_INTERVAL, self.poll_events, finish)
+
+    def validate(self, controller, events, cancel):
+        # runs on the worker thread, so no Tk calls in here: everything goes through the queue
+        spreadcheck, autocorrect = data_modules()
+        try:
+            rules = autocorrect.fields(controller.rules_file, autocorrect.user_cache_dir())
+            sheet_rules = spreadcheck.select_sheet_rules(rules, controller.sheet_rules)
+            # the review workbook is left until someone asks to see it
+            results = spreadcheck.clean(controller.data_file, rules, controller.temp_dir, events.put,
+                                        controller.chunksize, controller.flagged_only, controller.flags_sheet,
+                                        controller.comment_limit, controller.workers, sheet_rules, cancel, review=False,
+                                        profile=controller.temp_dir + '/validation.prof' if controller.profile else None)
+        except Exception as err:
+            results = spreadcheck.fail(spreadcheck.SpreadCheck(None), "ERROR: " + str(err))
+        events.put(results)
+
+    def poll_events(self, finish):
+        results = None
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(event, progress.Progress):
+                self.show_progress(event)
+            else:
+                results = event
+
+        if results is None:
+            self.after(POLL_INTERVAL, self.poll_events, finish)
+        else:
+            finish(results)
+
+    def show_progress(self, event):
+        start, end = STAGE_PROGRESS[event.stage]
+        if event.stage == progress.LOADING:
+            self.show_message(["Loading spreadsheet..."], "black")
+            return
+
+        if event.total is None:
+            # streamed files don't have a known length until the end
+            if str(self.progress['mode']) != 'indeterminate':
+                self.progress.config(mode='indeterminate')
+                self.progress.start()
+        else:
+            self.stop_indeterminate()
+            self.progress.config(value=start + (end - start) * event.rows / max(event.total, 1))
+        self.show_message(["{}: {:,} rows, {:,} flagged so far".format(event.stage, event.rows, event.flags)], "black")
+
+    def stop_indeterminate(self):
+        if str(self.progress['mode']) == 'indeterminate':
+            self.progress.stop()
+            self.progress.config(mode='determinate')
+
+    def cancel_validation(self):
+        self.cancel.set()
+        self.cancel_button.state(["disabled"])
+        self.show_message(["Cancelling..."], "black")
+
+    def finish_validation(self, controller, results):
+        self.stop_indeterminate()
+        self.validate_button.state(["!disabled"])
+        self.cancel_button.state(["disabled"])
+
         if results.errors:
-            self.message.config(state="normal")
-            self.message.delete(1.0, "end")
-            self.message.configure(fg="red")
-            for error in results.errors:
-                self.message.insert("end", error + '\n')
-            self.message.config(state="disabled")
+            self.progress.config(value=0)
+            self.show_message(results.errors, "red")
             return
         else:
+            self.progress.config(value=self.progress['maximum'])
             self.data_file_button.state(["!disabled"])
             self.next_button.state(["!disabled"])
-            self.message.config(state="normal")
-            self.message.delete(1.0, "end")
-            self.message.configure(fg="green")
-            for msg in results.messages:
-                self.message.insert("end", msg + '\n')
-            self.message.config(state="disabled")
-            controller.data_file = results.spreadsheet
+            self.show_message(results.messages + results.timings.summary(), "green")
+            controller.results = results
+
+    def view_flagged(self, controller):
+        results = controller.results
+        if results.written_at is not None:
+            controller.open_file(results.spreadsheet)
+            return
+
+        # writing the review workbook takes about as long as validating, so it goes through the same worker thread
+        self.validate_button.state(["disabled"])
+        self.data_file_button.state(["disabled"])
+        self.next_button.state(["disabled"])
+        self.cancel_button.state(["!disabled"])
+        self.progress.config(value=STAGE_PROGRESS[progress.WRITING][0])
+        self.show_message(["Writing review workbook..."], "black")
+        self.start_worker(self.write_review, results, lambda errors: self.finish_review(controller, errors))
+
+    def write_review(self, results, events, cancel):
+        # runs on the worker thread, putting the errors (none when it worked) on the queue once done
+        spreadcheck, _ = data_modules()
+        try:
+            spreadcheck.write_review(results, events.put, cancel)
+            errors = []
+        except progress.Cancelled:
+            errors = ["Review workbook cancelled"]
+        except Exception as err:
+            errors = ["ERROR: Unable to write review workbook. " + str(err)]
+        events.put(errors)
+
+    def finish_review(self, controller, errors):
+        self.stop_indeterminate()
+        self.validate_button.state(["!disabled"])
+        self.data_file_button.state(["!disabled"])
+        self.next_button.state(["!disabled"])
+        self.cancel_button.state(["disabled"])
+        self.progress.config(value=self.progress['maximum'])
+
+        if errors:
+            self.show_message(errors, "red")
+            return
+        results = controller.results
+        self.show_message(results.messages + results.timings.summary(), "green")
+        controller.open_file(results.spreadsheet)
+
+    def show_message(self, lines, color):
+        self.message.config(state="normal")
+        self.message.delete(1.0, "end")
+        self.message.configure(fg=color)
+        for line in lines:
+            self.message.insert("end", line + '\n')
+        self.message.config(state="disabled")
 
 class SaveExit(tk.Frame):  
     def __init__(self, parent, controller): 
@@ -269,7 +454,8 @@ class SaveExit(tk.Frame):
         self.write_name_label.grid(row=1, column=0, padx = 10, pady = 10)
         self.write_name_entry = tk.Entry(write_dir_frame, textvariable=controller.default_save_filename, width=40)
         self.write_name_entry.grid(row=1, column=1, padx = 10, pady = 10, sticky="w")
-        self.write_name_extension = ttk.Label(write_dir_frame, text=".csv")
+        self.write_name_extension = ttk.Combobox(write_dir_frame, values=[".csv", ".parquet"], state="readonly", width=8)
+        self.write_name_extension.set(".csv")
         self.write_name_extension.grid(row=1, column=2, pady = 10, sticky="w")
 
         # Save button
@@ -312,18 +498,18 @@ class SaveExit(tk.Frame):
             return
             
         try:
-            df = pd.read_excel(controller.temp_dir + '/temporary_file.xlsx')
-            df.to_csv(controller.write_dir + "/" + self.write_name_entry.get() +  ".csv")
+            destination = controller.write_dir + "/" + self.write_name_entry.get() + self.write_name_extension.get()
+            spreadcheck, _ = data_modules()
+            spreadcheck.save_cleaned(controller.results, destination)
             self.message.config(state="normal")
             self.message.delete(1.0, "end")
             self.message.configure(fg="green")
-            self.message.insert("end", "SUCCESS: File Saved at \n" + controller.write_dir + "/" + self.write_name_entry.get() + ".csv")
+            self.message.insert("end", "SUCCESS: File Saved at \n" + destination)
             self.message.config(state="disabled")
 
             self.save_button.state(["disabled"])
             self.next_button.state(["!disabled"])
-            if os.path.exists(controller.temp_dir + '/temporary_file.xlsx'):
-                os.remove(controller.temp_dir + '/temporary_file.xlsx')
+            remove_temporary_files(controller.temp_dir)
             
         except Exception as err:
             self.message.config(state="normal")
@@ -371,17 +557,37 @@ class MenuBar(Menu):
             controller.open_file(tutorial)
 
 
-# Driver Code 
-app = tkinterApp()
-app.title('Data Validation and Cleaning Tool') 
-app.mainloop()
+def remove_temporary_files(temp_dir):
+    # review workbooks are files, cleaned data is kept in folders of arrow files
+    for temp_file in glob.glob(temp_dir + '/temporary_file.*'):
+        if os.path.isdir(temp_file):
+            shutil.rmtree(temp_file)
+        else:
+            os.remove(temp_file)
+
 
-@atexit.register
 def cleanup():
-    fileList = glob.glob("./temp/*.xlsx")
+    fileList = glob.glob("./temp/*.xlsx") + glob.glob("./temp/*.arrow")
 
     for filePath in fileList:
         try:
-            os.remove(filePath)
+            if os.path.isdir(filePath):
+                shutil.rmtree(filePath)
+            else:
+                os.remove(filePath)
         except:
             print("Error while deleting file: " + filePath)
+
+
+# Driver Code 
+if __name__ == "__main__":
+    # spreadcheck's worker processes re-import this module where they can't fork (Windows),
+    # so only the main process may start the gui
+    multiprocessing.freeze_support()
+    atexit.register(cleanup)
+
+    app = tkinterApp()
+    app.title('Data Validation and Cleaning Tool') 
+    # the window paints first, then the data modules load while the user picks files
+    app.after(PRELOAD_DELAY, preload)
+    app.mainloop()